@@ -0,0 +1,168 @@
+"""
+Dependency graph of the generated files.
+
+Every artifact declares the configuration keys, templates, input files and
+other artifacts it is built from. A hash of all those inputs is stored next
+to the output in the build directory, so that an artifact is only generated
+again when one of its inputs changes.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+
+from templates import get_template
+
+
+STAMPS_FILE = '.stamps'
+
+# Modules used by the generators, whose changes can alter any artifact
+HELPER_MODULES = ('templates.py', 'sizing.py', 'roles.py')
+
+
+def _hash_file(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _code_hashes(func):
+    """
+    Hashes of the file defining `func` and of the helper modules
+    """
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [inspect.getsourcefile(func)] + [os.path.join(base_dir, module) for module in HELPER_MODULES]
+    return [_hash_file(path) for path in paths]
+
+
+class Artifact(object):
+    def __init__(self, name, func, keys, templates, deps, files, sources):
+        self.name = name
+        self.func = func
+        self.keys = keys
+        self.templates = templates
+        self.deps = deps
+        self.files = files
+        self.sources = sources
+
+    def stamp(self, conf_dict, tpl_dir, dep_stamps):
+        files = {}
+        for key in self.files:
+            paths = conf_dict.get(key) or []
+            if not isinstance(paths, list):
+                paths = [paths]
+            files[key] = [_hash_file(path) for path in paths]
+
+        inputs = {
+            'name': self.name,
+            'conf': dict((key, conf_dict.get(key)) for key in self.keys),
+            'templates': [get_template(os.path.join(tpl_dir, tpl)).digest for tpl in self.templates],
+            'deps': [dep_stamps[dep] for dep in self.deps],
+            # the code that generates the artifact is an input too
+            'code': _code_hashes(self.func),
+            'files': files,
+            'sources': [_hash_file(path) for path in self.sources]
+        }
+        data = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def build(self, conf_dict, rendered):
+        # Only pass the declared keys, so that an undeclared dependency fails loudly
+        view = dict((key, conf_dict[key]) for key in self.keys if key in conf_dict)
+        if self.deps:
+            return self.func(view, dict((dep, rendered[dep]) for dep in self.deps))
+        return self.func(view)
+
+
+class ArtifactGraph(object):
+    def __init__(self):
+        self.artifacts = []
+
+    def register(self, name, keys=(), templates=(), deps=(), files=(), sources=()):
+        """
+        `files` are config keys pointing to input files, `sources` are other
+        local files whose content ends up in the artifact
+        """
+
+        known = set(a.name for a in self.artifacts)
+        for dep in deps:
+            if dep not in known:
+                raise ValueError("Artifact '{0}' depends on unknown artifact '{1}'".format(name, dep))
+
+        def _decorator(func):
+            self.artifacts.append(Artifact(name, func, tuple(keys), tuple(templates), tuple(deps), tuple(files),
+                                           tuple(sources)))
+            return func
+        return _decorator
+
+
+def load_stamps(build_dir):
+    try:
+        with open(os.path.join(build_dir, STAMPS_FILE), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_stamps(build_dir, stamps):
+    with open(os.path.join(build_dir, STAMPS_FILE), 'w') as f:
+        json.dump(stamps, f, indent=2, sort_keys=True)
+
+
+def build(graph, conf_dict, tpl_dir, stamps):
+    """
+    Build all the artifacts of `graph` into the build directory, reusing the
+    ones whose inputs haven't changed. `stamps` is updated in place.
+
+    Returns the content of every artifact and the names of the ones that
+    were (re)generated.
+    """
+
+    build_dir = conf_dict['build_dir']
+    rendered = {}
+    new_stamps = {}
+    generated = []
+
+    for artifact in graph.artifacts:
+        stamp = artifact.stamp(conf_dict, tpl_dir, new_stamps)
+        new_stamps[artifact.name] = stamp
+        out_path = os.path.join(build_dir, artifact.name)
+
+        if stamps.get(artifact.name) == stamp and os.path.isfile(out_path):
+            with open(out_path, 'r') as f:
+                rendered[artifact.name] = f.read()
+            continue
+
+        content = artifact.build(conf_dict, rendered)
+        with open(out_path, 'w') as f:
+            f.write(content)
+        rendered[artifact.name] = content
+        generated.append(artifact.name)
+
+    stamps.update(new_stamps)
+    return rendered, generated
+
+
+def render(graph, conf_dict):
+    """
+    Build all the artifacts of `graph` in memory, without looking at the stamps.
+
+    Returns the content of every artifact and the exception raised by each one
+    that failed (the artifacts depending on a failed one are skipped).
+    """
+
+    rendered = {}
+    failed = {}
+
+    for artifact in graph.artifacts:
+        if any(dep not in rendered for dep in artifact.deps):
+            continue
+        try:
+            rendered[artifact.name] = artifact.build(conf_dict, rendered)
+        except (KeyError, ValueError, IOError, OSError) as e:
+            failed[artifact.name] = e
+
+    return rendered, failed
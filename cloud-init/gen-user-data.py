@@ -4,17 +4,114 @@ try:
     input = raw_input
 except NameError:
     pass
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 import argparse
+import base64
+import copy
+import gzip
+import hashlib
+import multiprocessing
 import os
 import re
+import sys
+import time
+from io import BytesIO
+
+from fabric.colors import cyan, green, red, yellow
+from yaml import SafeDumper, dump, load, safe_load
 
-from fabric.colors import cyan, green, red
-from yaml import dump, load
+import artifacts
+import mirror
+import roles
+import sizing
+import validate
+from templates import render
+from write_mime_multipart import build_multipart, encode_multipart
 
 
 tpl_dir = './tpl'
 
+# Set in fleet workers, so that the output of parallel runs doesn't get mixed up
+quiet = False
+
+ssh_key_re = r'^ssh-\w+ [a-zA-Z0-9+/]+={0,2} \w+@.+$'
+
+# Encodings of the files written by cloud-config ('auto' compresses the ones that get smaller)
+file_encodings = ('plain', 'gz+b64', 'auto')
+
+# Maximum size of the user-data (before any base64 encoding), per cloud provider.
+# Nova limits the base64-encoded user-data to 65535 bytes.
+provider_limits = {
+    'ec2': 16 * 1024,
+    'openstack': 65535 // 4 * 3
+}
+
+compress_modes = ('auto', 'always', 'never')
+
+# Persistence of the Redis instances: 'default' takes snapshots (RDB), 'durable' logs every write
+# (AOF, synced every second) and 'cache' doesn't persist anything and may evict any key
+redis_profiles = {
+    'default': {'save': ['900 1', '300 10', '60 1000'], 'appendonly': 'no'},
+    'durable': {'save': [], 'appendonly': 'yes'},
+    'cache': {'save': [], 'appendonly': 'no', 'maxmemory_policy': 'allkeys-lru'}
+}
+
+# Resource limits of the services (systemd): CPU weight, CPU quota ('100%' being one core) and
+# memory. The scheduler gets the least, so that it can't starve the WSGI processes. They can be
+# overridden with the `service_limits` key of the configuration.
+service_limits = {
+    'httpd': {'cpu_shares': 2048},
+    'zeo': {'cpu_shares': 1024},
+    'redis': {'cpu_shares': 1024},
+    'scheduler': {'cpu_shares': 256, 'cpu_quota': '100%', 'memory_limit': '1G'}
+}
+
+# Files generated into the build directory, see `artifacts.py`
+build_graph = artifacts.ArtifactGraph()
+
+# 'full' does everything on the first boot, 'bake' only installs what is common to all
+# instances (golden image) and 'personalize' configures an instance of a baked image
+stages = ('full', 'bake', 'personalize')
+
+# Packages installed on the instances
+yum_packages = ['iptables-services', 'python-devel', 'python-virtualenv', 'gcc', 'httpd', 'mod_wsgi',
+                'python-reportlab', 'python-imaging', 'mod_ssl', 'mod_xsendfile', 'redis', 'openldap-devel',
+                'libffi-devel', 'libxml-devel', 'libxslt-devel']
+python_packages = ['python-ldap', 'indico']
+
+# Steps of the user-data script (see `tpl/steps`), the stages they are part of, the steps
+# they depend on ('*' meaning all the previous ones) and, optionally, a condition on the
+# configuration (e.g. the role of the instance). Independent steps run in parallel (see
+# `tpl/step-runner.sh`), except the ones using yum, which are chained.
+script_steps = [
+    ('networking', stages, []),
+    ('mirror', ('full', 'bake'), ['networking']),
+    ('epel', ('full', 'bake'), ['mirror']),
+    ('sudoers_open', stages, []),
+    ('packages', ('full', 'bake'), ['epel']),
+    ('virtualenv', ('full', 'bake'), ['packages'], roles.runs_indico),
+    ('python_deps', ('full', 'bake'), ['virtualenv'], roles.runs_indico),
+    ('indico_setup', ('full', 'bake'), ['python_deps'], roles.runs_indico),
+    ('httpd', ('full', 'personalize'), ['packages'], lambda conf_dict: roles.runs(conf_dict, 'httpd')),
+    ('ssl', ('full', 'personalize'), [], lambda conf_dict: roles.runs(conf_dict, 'httpd')),
+    ('iptables', ('full', 'personalize'), ['packages']),
+    ('postfix', ('full', 'personalize'), [], lambda conf_dict: roles.runs(conf_dict, 'httpd', 'scheduler')),
+    ('selinux', ('full', 'bake'), ['indico_setup'], roles.runs_indico),
+    ('redis', ('full', 'personalize'), ['packages'],
+     lambda conf_dict: roles.runs(conf_dict, 'redis') and (conf_dict.get('redis_split') or _redis_socket(conf_dict))),
+    ('db_pack', ('full', 'personalize'), ['indico_setup'],
+     lambda conf_dict: roles.runs(conf_dict, 'db') and conf_dict.get('db_pack_schedule')),
+    ('sizing', ('full', 'personalize'), [], lambda conf_dict: conf_dict.get('sizing') == 'auto'),
+    ('config_files', ('full', 'personalize'), ['packages', 'indico_setup', 'httpd', 'sizing']),
+    ('units', ('full', 'personalize'), ['packages', 'redis']),
+    ('services', ('personalize',), '*'),
+    ('sudoers_close', stages, '*')
+]
+
 
 def _yes_no_input(message, default):
     c = '? '
@@ -39,19 +136,9 @@ def _read_file(fname):
         return f.read()
 
 
-def _add_tabs(old_content):
-    new_content = ''
-    for line in old_content.splitlines(True):
-        new_line = line
-        if line != '\n':
-            new_line = '        ' + line
-        new_content = new_content + new_line
-    return new_content
-
-
 def _get_ssh_key(fname):
     data = _read_file(fname).strip()
-    if re.match(r'^ssh-\w+ [a-zA-Z0-9+/]+={0,2} \w+@.+$', data):
+    if re.match(ssh_key_re, data):
         return data
     else:
         print(red("Key in '{0}' doesn't seem to be valid! It will be ignored.".format(fname)))
@@ -134,58 +221,393 @@ def config():
     return conf_dict
 
 
-def _gen_file(rules_dict, in_path, out_path):
-    print("Generating {0}... ".format(os.path.basename(in_path)), end="")
-    with open(in_path, 'r') as fin:
-        with open(out_path, 'w+') as fout:
-            fout.write(fin.read().format(**rules_dict))
-    print(cyan("done".format(os.path.basename(in_path))))
-
-
+def _wsgi_groups(conf_dict):
+    """
+    Names of the WSGI daemon groups (connections are routed by the client port, see `_wsgi_port_pattern`)
+    """
+
+    count = int(conf_dict.get('wsgi_groups', 1))
+    if not 1 <= count <= 10:
+        raise ValueError("'wsgi_groups' must be between 1 and 10")
+    return ['WSGIDAEMON'] if count == 1 else ['WSGIDAEMON{0}'.format(i + 1) for i in range(count)]
+
+
+def _wsgi_port_pattern(index, count):
+    """
+    Regex matching the client ports routed to group `index` out of `count`.
+
+    The ports are split into 100 classes by their tens and hundreds digits, dealt out to the groups in turn,
+    so that each group gets within one percent of an equal share. The last digit is left out since Linux
+    clients mostly connect from even ports.
+    """
+
+    alternatives = []
+    for hundreds in range(10):
+        tens = ''.join(str(digit) for digit in range(10) if (hundreds * 10 + digit) % count == index)
+        if tens:
+            alternatives.append('{0}{1}'.format(hundreds, tens if len(tens) == 1 else '[{0}]'.format(tens)))
+    return '({0})[0-9]$'.format('|'.join(alternatives))
+
+
+def _gen_file(rules_dict, tpl_name):
+    if not quiet:
+        print("Generating {0}... ".format(tpl_name), end="")
+    content = render(os.path.join(tpl_dir, tpl_name), rules_dict)
+    if not quiet:
+        print(cyan("done"))
+    return content
+
+
+@build_graph.register('indico_httpd.conf',
+                       templates=['indico_httpd.conf', 'indico_httpd_static.conf', 'indico_httpd_ssl.conf',
+                                  'indico_httpd_ocsp.conf', 'indico_httpd_status.conf', 'indico_httpd_wsgi.conf',
+                                  'indico_httpd_preload.conf', 'indico_httpd_routing.conf'],
+                       sources=['sizing.py'],
+                       keys=['indico_inst_dir', 'ssl_certs_dir', 'ssl_private_dir', 'pem_source', 'key_source',
+                             'sizing', 'cpus', 'ram_mb', 'static_tuning', 'static_max_age', 'keepalive',
+                             'keepalive_timeout', 'max_keepalive_requests', 'mpm_max_workers', 'ssl_session_cache',
+                             'ssl_session_timeout', 'ocsp_stapling', 'status_endpoints', 'wsgi_groups',
+                             'wsgi_preload'])
 def _gen_indico_httpd_conf(conf_dict):
-    in_path = os.path.join(tpl_dir, 'indico_httpd.conf')
-    out_path = os.path.join(conf_dict['build_dir'], 'indico_httpd.conf')
+    mpm_max_workers = int(conf_dict.get('mpm_max_workers', 256))
     rules_dict = {
         'indico_inst_dir': conf_dict['indico_inst_dir'],
         'ssl_pem_path': os.path.join(conf_dict['ssl_certs_dir'], os.path.basename(conf_dict['pem_source'])),
-        'ssl_key_path': os.path.join(conf_dict['ssl_private_dir'], os.path.basename(conf_dict['key_source']))
+        'ssl_key_path': os.path.join(conf_dict['ssl_private_dir'], os.path.basename(conf_dict['key_source'])),
+        'static_block': '',
+        'ssl_tuning': '',
+        'status_block': '',
+        'keepalive': 'On' if conf_dict.get('keepalive', True) else 'Off',
+        'keepalive_timeout': conf_dict.get('keepalive_timeout', 5),
+        'max_keepalive_requests': conf_dict.get('max_keepalive_requests', 100),
+        'mpm_max_workers': mpm_max_workers,
+        # threaded MPMs run 25 threads per child by default
+        'mpm_server_limit': (mpm_max_workers + 24) // 25
     }
+    rules_dict.update(sizing.settings(conf_dict))
 
-    _gen_file(rules_dict, in_path, out_path)
+    if conf_dict.get('ssl_session_cache'):
+        rules_dict['ssl_tuning'] += render(os.path.join(tpl_dir, 'indico_httpd_ssl.conf'), {
+            'ssl_session_cache': conf_dict['ssl_session_cache'],
+            'ssl_session_timeout': conf_dict.get('ssl_session_timeout', 300)
+        })
 
+    if conf_dict.get('ocsp_stapling'):
+        rules_dict['ssl_tuning'] += render(os.path.join(tpl_dir, 'indico_httpd_ocsp.conf'), {})
 
+    if conf_dict.get('status_endpoints'):
+        rules_dict['status_block'] = render(os.path.join(tpl_dir, 'indico_httpd_status.conf'), {})
+
+    groups = _wsgi_groups(conf_dict)
+    rules_dict['wsgi_daemons'] = ''.join(render(os.path.join(tpl_dir, 'indico_httpd_wsgi.conf'), {
+        'indico_inst_dir': conf_dict['indico_inst_dir'],
+        'wsgi_group': group,
+        'wsgi_processes': rules_dict['wsgi_processes_{0}'.format(i)],
+        'wsgi_threads': rules_dict['wsgi_threads'],
+        'wsgi_maximum_requests': rules_dict['wsgi_maximum_requests_{0}'.format(i)]
+    }) for i, group in enumerate(groups)).rstrip('\n')
+
+    if conf_dict.get('wsgi_preload'):
+        # in the application group of the requests, so that they use the interpreter loaded at startup
+        rules_dict['wsgi_daemons'] += '\n\n' + render(os.path.join(tpl_dir, 'indico_httpd_preload.conf'), {
+            'wsgi_imports': '\n'.join(
+                'WSGIImportScript "{0}/htdocs/indico.wsgi" process-group={1} application-group=%{{GLOBAL}}'.format(
+                    conf_dict['indico_inst_dir'], group) for group in groups)
+        }).rstrip('\n')
+
+    if len(groups) > 1:
+        routing = ['', '', render(os.path.join(tpl_dir, 'indico_httpd_routing.conf'), {}).rstrip('\n')]
+        for i, group in enumerate(groups):
+            routing.append('        RewriteCond %{{REMOTE_PORT}} {0}'.format(_wsgi_port_pattern(i, len(groups))))
+            routing.append('        RewriteRule ^ - [E=INDICO_WSGI_GROUP:{0}]'.format(group))
+        rules_dict['wsgi_routing'] = '\n'.join(routing + [''])
+        rules_dict['wsgi_process_group'] = '%{ENV:INDICO_WSGI_GROUP}'
+    else:
+        rules_dict['wsgi_routing'] = ''
+        rules_dict['wsgi_process_group'] = groups[0]
+
+    if conf_dict.get('static_tuning'):
+        rules_dict['static_block'] = '\n' + render(os.path.join(tpl_dir, 'indico_httpd_static.conf'), {
+            'indico_inst_dir': conf_dict['indico_inst_dir'],
+            'static_max_age': conf_dict.get('static_max_age', 30)
+        }).rstrip('\n')
+
+    return _gen_file(rules_dict, 'indico_httpd.conf')
+
+
+@build_graph.register('indico_indico.conf', templates=['indico_indico.conf'],
+                       keys=['redis_pswd', 'redis_host', 'redis_port', 'host_name', 'indico_inst_dir',
+                             'smtp_server_name', 'smtp_server_port', 'smtp_login', 'smtp_pswd', 'static_tuning',
+                             'db_host', 'db_port', 'role', 'redis_split', 'redis_cache_port', 'redis_unix_socket',
+                             'db_unix_socket', 'db_inst_dir'],
+                       sources=['roles.py'])
 def _gen_indico_indico_conf(conf_dict):
-    in_path = os.path.join(tpl_dir, 'indico_indico.conf')
-    out_path = os.path.join(conf_dict['build_dir'], 'indico_indico.conf')
+    main, cache = _redis_instances(conf_dict)
     rules_dict = {
-        'redis_pswd': conf_dict['redis_pswd'],
-        'redis_host': conf_dict['redis_host'],
-        'redis_port': conf_dict['redis_port'],
+        # The cache lives in its own instance, or in another db of the main one
+        'redis_url': _redis_url(conf_dict, main, 0),
+        'redis_cache_url': _redis_url(conf_dict, cache, 0) if cache else _redis_url(conf_dict, main, 1),
         'host_name': conf_dict['host_name'],
         'indico_inst_dir': conf_dict['indico_inst_dir'],
         'smtp_server_name': conf_dict['smtp_server_name'],
         'smtp_server_port': conf_dict['smtp_server_port'],
         'smtp_login': conf_dict['smtp_login'],
-        'smtp_pswd': conf_dict['smtp_pswd']
+        'smtp_pswd': conf_dict['smtp_pswd'],
+        # ZEO accepts the path of a Unix socket instead of (host, port)
+        'db_connection_params': ("'{0}'".format(_db_socket(conf_dict)) if _db_socket(conf_dict) else
+                                 "('{0}', {1})".format(conf_dict.get('db_host', 'localhost'),
+                                                       conf_dict.get('db_port', 9675))),
+        'use_xsendfile': 'yes' if conf_dict.get('static_tuning') else 'no'
     }
 
-    _gen_file(rules_dict, in_path, out_path)
+    return _gen_file(rules_dict, 'indico_indico.conf')
 
 
-def _gen_redis_conf(conf_dict):
-    in_path = os.path.join(tpl_dir, 'redis.conf')
-    out_path = os.path.join(conf_dict['build_dir'], 'redis.conf')
+def _db_socket(conf_dict):
+    """
+    Unix socket of the ZEO server, only used if the Indico clients run on the same machine
+    """
+
+    if conf_dict.get('db_unix_socket') and roles.runs(conf_dict, 'db') and roles.runs(conf_dict, 'httpd', 'scheduler'):
+        return os.path.join(conf_dict['db_inst_dir'], 'zeo.sock')
+    return None
+
+
+def _zeopack_address(conf_dict):
+    socket = _db_socket(conf_dict)
+    if socket:
+        return '-U {0}'.format(socket)
+    return '-h localhost -p {0}'.format(conf_dict.get('db_port', 9675))
+
+
+@build_graph.register('indico_zodb.conf', templates=['indico_zodb.conf'],
+                       keys=['indico_inst_dir', 'db_inst_dir', 'db_bind', 'db_port', 'db_unix_socket', 'role',
+                             'sizing', 'cpus', 'ram_mb', 'status_endpoints', 'db_monitor_port'],
+                       sources=['roles.py'])
+def _gen_indico_zodb_conf(conf_dict):
+    socket = _db_socket(conf_dict)
     rules_dict = {
+        'indico_inst_dir': conf_dict['indico_inst_dir'],
+        'db_inst_dir': conf_dict['db_inst_dir'],
+        'zeo_address': socket or '{0}:{1}'.format(conf_dict.get('db_bind', 'localhost'),
+                                                  conf_dict.get('db_port', 9675)),
+        # The monitor server prints the statistics of the storage to whoever connects
+        'zeo_monitor': ('\n  monitor-address localhost:{0}'.format(conf_dict.get('db_monitor_port', 9676))
+                        if conf_dict.get('status_endpoints') else '')
+    }
+    rules_dict.update(sizing.settings(conf_dict))
+
+    return _gen_file(rules_dict, 'indico_zodb.conf')
+
+
+def _redis_socket(conf_dict, name='redis'):
+    """
+    Unix socket of a Redis instance, only used if the Indico clients run on the same machine
+    """
+
+    if conf_dict.get('redis_unix_socket') and roles.runs(conf_dict, 'redis') and roles.runs_indico(conf_dict):
+        return '/var/run/redis/{0}.sock'.format(name)
+    return None
+
+
+def _redis_instances(conf_dict):
+    """
+    (name, port, profile) of the main Redis instance and of the cache one, if any
+    """
+
+    main = ('redis', conf_dict['redis_port'], conf_dict.get('redis_profile', 'default'))
+    if conf_dict.get('redis_split'):
+        return main, ('redis-cache', conf_dict.get('redis_cache_port', 6380), 'cache')
+    return main, None
+
+
+def _redis_url(conf_dict, instance, db):
+    name, port = instance[:2]
+    socket = _redis_socket(conf_dict, name)
+    if socket:
+        return 'unix://unused:{0}@{1}?db={2}'.format(conf_dict['redis_pswd'], socket, db)
+    return 'redis://unused:{0}@{1}:{2}/{3}'.format(conf_dict['redis_pswd'], conf_dict['redis_host'], port, db)
+
+
+def _redis_conf(conf_dict, instance):
+    name, port, profile = instance
+    if profile not in redis_profiles:
+        raise ValueError("Unknown Redis profile '{0}' (choose from {1})".format(
+            profile, ', '.join(sorted(redis_profiles))))
+    persistence = redis_profiles[profile]
+    socket = _redis_socket(conf_dict, name)
+
+    rules_dict = {
+        'redis_name': name,
         'redis_pswd': conf_dict['redis_pswd'],
-        'redis_port': conf_dict['redis_port']
+        'redis_port': port,
+        'redis_bind': conf_dict.get('redis_bind', '127.0.0.1'),
+        'redis_socket': '\n\nunixsocket {0}\nunixsocketperm 770'.format(socket) if socket else '',
+        'redis_save': '\n'.join('save ' + s for s in persistence['save']) or 'save ""',
+        'redis_dbfilename': 'dump.rdb' if name == 'redis' else '{0}.rdb'.format(name),
+        'redis_appendonly': persistence['appendonly'],
+        # Record the events slower than 100 ms (see LATENCY LATEST), 0 disables it
+        'redis_latency_monitor': 100 if conf_dict.get('status_endpoints') else 0
+    }
+    rules_dict.update(sizing.settings(conf_dict))
+
+    if name == 'redis-cache':
+        # Its own share of the Redis memory, the main instance keeps the rest
+        rules_dict['redis_maxmemory'] = conf_dict.get('redis_cache_maxmemory', rules_dict['redis_cache_maxmemory'])
+    elif 'maxmemory_policy' in persistence and rules_dict['redis_maxmemory'] == '0':
+        # A cache must be bounded
+        rules_dict['redis_maxmemory'] = conf_dict.get('redis_cache_maxmemory', '256mb')
+    if 'maxmemory_policy' in persistence:
+        rules_dict['redis_maxmemory_policy'] = persistence['maxmemory_policy']
+
+    return _gen_file(rules_dict, 'redis.conf')
+
+
+@build_graph.register('redis.conf', templates=['redis.conf'],
+                       keys=['redis_pswd', 'redis_port', 'redis_bind', 'sizing', 'cpus', 'ram_mb', 'redis_profile',
+                             'redis_split', 'redis_cache_maxmemory', 'redis_unix_socket', 'role', 'status_endpoints'],
+                       sources=['roles.py'])
+def _gen_redis_conf(conf_dict):
+    return _redis_conf(conf_dict, _redis_instances(conf_dict)[0])
+
+
+@build_graph.register('redis-cache.conf', templates=['redis.conf'],
+                       keys=['redis_pswd', 'redis_port', 'redis_bind', 'sizing', 'cpus', 'ram_mb', 'redis_split',
+                             'redis_cache_port', 'redis_cache_maxmemory', 'redis_unix_socket', 'role',
+                             'status_endpoints'],
+                       sources=['roles.py'])
+def _gen_redis_cache_conf(conf_dict):
+    # Always rendered, but only shipped if `redis_split` is set
+    return _redis_conf(conf_dict, ('redis-cache', conf_dict.get('redis_cache_port', 6380), 'cache'))
+
+
+def _units(conf_dict):
+    """
+    systemd units of the services run by the instance
+    """
+
+    units = []
+    if roles.runs(conf_dict, 'redis'):
+        units += ['redis', 'redis-cache'] if conf_dict.get('redis_split') else ['redis']
+    if roles.runs(conf_dict, 'db'):
+        units.append('indico-zeo')
+    if roles.runs(conf_dict, 'httpd'):
+        units.append('httpd')
+    if roles.runs(conf_dict, 'scheduler'):
+        units.append('indico-scheduler')
+    return units
+
+
+def _unit_limits(conf_dict, service):
+    limits = dict(service_limits[service])
+    limits.update((conf_dict.get('service_limits') or {}).get(service) or {})
+    unknown = set(limits) - set(['cpu_shares', 'cpu_quota', 'memory_limit'])
+    if unknown:
+        raise ValueError("Unknown limits for '{0}': {1}".format(service, ', '.join(sorted(unknown))))
+
+    lines = ['CPUAccounting=yes', 'MemoryAccounting=yes']
+    for key, directive in (('cpu_shares', 'CPUShares'), ('cpu_quota', 'CPUQuota'), ('memory_limit', 'MemoryLimit')):
+        if limits.get(key):
+            lines.append('{0}={1}'.format(directive, limits[key]))
+    return '\n'.join(lines)
+
+
+def _local_deps(conf_dict):
+    """
+    Units of the database and Redis, if they run on the same instance
+    """
+
+    return [unit for unit in _units(conf_dict) if unit in ('redis', 'redis-cache', 'indico-zeo')]
+
+
+def _port_ready(bind, port):
+    host = bind.split()[0] if bind and bind.split()[0] != '0.0.0.0' else '127.0.0.1'
+    return '(echo > /dev/tcp/{0}/{1}) 2>/dev/null'.format(host, port)
+
+
+@build_graph.register('indico-zeo.service', templates=['indico-zeo.service'],
+                       keys=['indico_inst_dir', 'db_inst_dir', 'db_bind', 'db_port', 'db_unix_socket', 'role',
+                             'service_limits'],
+                       sources=['roles.py'])
+def _gen_zeo_unit(conf_dict):
+    socket = _db_socket(conf_dict)
+    rules_dict = {
+        'indico_inst_dir': conf_dict['indico_inst_dir'],
+        'db_inst_dir': conf_dict['db_inst_dir'],
+        # A socket left behind by a crash would look ready
+        'zeo_start_pre': '\nExecStartPre=/bin/rm -f {0}'.format(socket) if socket else '',
+        'zeo_ready': ('test -S {0}'.format(socket) if socket else
+                      _port_ready(conf_dict.get('db_bind', 'localhost'), conf_dict.get('db_port', 9675))),
+        'limits': _unit_limits(conf_dict, 'zeo')
+    }
+
+    return _gen_file(rules_dict, 'indico-zeo.service')
+
+
+@build_graph.register('indico-scheduler.service', templates=['indico-scheduler.service'],
+                       keys=['indico_inst_dir', 'role', 'redis_split', 'service_limits'], sources=['roles.py'])
+def _gen_scheduler_unit(conf_dict):
+    deps = ' '.join(unit + '.service' for unit in _local_deps(conf_dict))
+    rules_dict = {
+        'indico_inst_dir': conf_dict['indico_inst_dir'],
+        'wants': '\nWants={0}'.format(deps) if deps else '',
+        'limits': _unit_limits(conf_dict, 'scheduler')
+    }
+
+    return _gen_file(rules_dict, 'indico-scheduler.service')
+
+
+@build_graph.register('httpd.service.conf', templates=['service-dropin.conf'],
+                       keys=['role', 'redis_split', 'service_limits'], sources=['roles.py'])
+def _gen_httpd_dropin(conf_dict):
+    deps = ' '.join(unit + '.service' for unit in _local_deps(conf_dict))
+    rules_dict = {
+        'unit_deps': '\nAfter=indico-zeo.service redis.service redis-cache.service' +
+                     ('\nWants={0}'.format(deps) if deps else ''),
+        'ready_check': '',
+        'limits': _unit_limits(conf_dict, 'httpd')
     }
 
-    _gen_file(rules_dict, in_path, out_path)
+    return _gen_file(rules_dict, 'service-dropin.conf')
 
 
+def _redis_dropin(conf_dict, port):
+    rules_dict = {
+        'unit_deps': '\nBefore=httpd.service indico-scheduler.service',
+        # Only started once it accepts connections, so that the units ordered after it can connect
+        'ready_check': "\nExecStartPost=/bin/bash -c 'for i in {{1..300}}; do {0} && exit 0; sleep 0.1; done; "
+                       "exit 1'".format(_port_ready(conf_dict.get('redis_bind', '127.0.0.1'), port)),
+        'limits': _unit_limits(conf_dict, 'redis')
+    }
+
+    return _gen_file(rules_dict, 'service-dropin.conf')
+
+
+@build_graph.register('redis.service.conf', templates=['service-dropin.conf'],
+                       keys=['redis_port', 'redis_bind', 'service_limits'])
+def _gen_redis_dropin(conf_dict):
+    return _redis_dropin(conf_dict, conf_dict['redis_port'])
+
+
+@build_graph.register('redis-cache.service.conf', templates=['service-dropin.conf'],
+                       keys=['redis_cache_port', 'redis_bind', 'service_limits'])
+def _gen_redis_cache_dropin(conf_dict):
+    return _redis_dropin(conf_dict, conf_dict.get('redis_cache_port', 6380))
+
+
+@build_graph.register('user-data-script.sh',
+                       templates=['user-data-script.sh', 'step-runner.sh'] +
+                                 ['steps/{0}.sh'.format(step[0]) for step in script_steps],
+                       sources=['sizing.py', 'roles.py'],
+                       keys=['stage', 'sizing', 'indico_inst_dir', 'db_inst_dir', 'httpd_conf_dir', 'httpd_confd_dir',
+                             'host_name', 'ssl_certs_dir', 'ssl_private_dir', 'load_ssl', 'pem_source', 'key_source',
+                             'postfix', 'smtp_server_port', 'enable_networking', 'mirror_url', 'mirror_disk_label',
+                             'ssl_session_cache', 'role', 'cluster_network', 'db_port', 'redis_port',
+                             'redis_split', 'redis_cache_port', 'redis_unix_socket', 'db_unix_socket',
+                             'db_pack_schedule', 'db_pack_days', 'wsgi_groups'])
 def _gen_script(conf_dict):
-    in_path = os.path.join(tpl_dir, 'user-data-script.sh')
-    out_path = os.path.join(conf_dict['build_dir'], 'user-data-script.sh')
+    stage = conf_dict.get('stage', 'full')
+    use_mirror, mirror_url = mirror.mirror_settings(conf_dict)
     rules_dict = {
         'indico_inst_dir': conf_dict['indico_inst_dir'],
         'db_inst_dir': conf_dict['db_inst_dir'],
@@ -199,98 +621,557 @@ def _gen_script(conf_dict):
         'ssl_key_filename': os.path.basename(conf_dict['key_source']),
         'postfix': str(conf_dict['postfix']).lower(),
         'smtp_server_port': conf_dict['smtp_server_port'],
-        'enable_networking': str(conf_dict['enable_networking']).lower()
+        'enable_networking': str(conf_dict['enable_networking']).lower(),
+        'use_mirror': str(use_mirror).lower(),
+        'mirror_url': mirror_url,
+        'mirror_disk_label': conf_dict.get('mirror_disk_label') or '',
+        'yum_opts': "--disablerepo='*' --enablerepo=indico-mirror " if use_mirror else '',
+        'yum_packages': ' '.join(roles.packages(conf_dict, yum_packages)),
+        'python_packages': ' '.join(python_packages),
+        'sizing_module': _read_file('sizing.py'),
+        'wsgi_groups': len(_wsgi_groups(conf_dict)),
+        'sizing_paths': ' '.join(_file_targets(conf_dict)[fname][0] for fname in (
+            'indico_httpd.conf', 'redis.conf', 'redis-cache.conf', 'indico_zodb.conf')),
+        'ssl_session_cache': conf_dict.get('ssl_session_cache') or '',
+        'firewall_rules': roles.firewall_rules(conf_dict),
+        'db_pack_schedule': conf_dict.get('db_pack_schedule') or '',
+        'db_pack_days': conf_dict.get('db_pack_days', 7),
+        'zeopack_address': _zeopack_address(conf_dict),
+        'run_redis': str(roles.runs(conf_dict, 'redis')).lower(),
+        'run_db': str(roles.runs(conf_dict, 'db')).lower(),
+        'run_httpd': str(roles.runs(conf_dict, 'httpd')).lower(),
+        'redis_split': str(bool(conf_dict.get('redis_split'))).lower(),
+        'redis_unix_socket': str(bool(_redis_socket(conf_dict))).lower(),
+        'units': ' '.join(_units(conf_dict))
     }
 
-    _gen_file(rules_dict, in_path, out_path)
+    # Every step becomes a function, called by the runner once its dependencies (among the
+    # steps of this stage) are done
+    steps = []
+    step_deps = []
+    for step in script_steps:
+        name, step_stages, deps, condition = (step + (None,))[:4]
+        if stage not in step_stages or (condition and not condition(conf_dict)):
+            continue
+        deps = steps[:] if deps == '*' else [dep for dep in deps if dep in steps]
+        steps.append(name)
+        step_deps.append('deps[{0}]="{1}"'.format(name, ' '.join(deps)))
+
+    rules_dict['steps'] = '\n'.join('function step_{0}(){{\n{1}\n}}\n'.format(
+        name, render(os.path.join(tpl_dir, 'steps', '{0}.sh'.format(name)), rules_dict).rstrip('\n'))
+        for name in steps)
+    rules_dict['runner'] = render(os.path.join(tpl_dir, 'step-runner.sh'), {
+        'stage': stage,
+        'step_names': ' '.join(steps),
+        'step_deps': '\n'.join(step_deps)
+    })
 
+    return _gen_file(rules_dict, 'user-data-script.sh')
+
+
+def _shipped_files(conf_dict):
+    """
+    Generated files and SSL files (config keys) written by cloud-config
+    """
+
+    # A baked image doesn't contain any instance-specific configuration
+    if conf_dict.get('stage', 'full') == 'bake':
+        return [], []
+
+    # Only ship the files used by the role of the instance
+    fnames = [fname for fname, used in (('indico_httpd.conf', roles.runs(conf_dict, 'httpd')),
+                                        ('indico_indico.conf', roles.runs_indico(conf_dict)),
+                                        ('indico_zodb.conf', roles.runs(conf_dict, 'db')),
+                                        ('redis.conf', roles.runs(conf_dict, 'redis')),
+                                        ('redis-cache.conf', roles.runs(conf_dict, 'redis') and
+                                         conf_dict.get('redis_split')),
+                                        ('indico-zeo.service', roles.runs(conf_dict, 'db')),
+                                        ('indico-scheduler.service', roles.runs(conf_dict, 'scheduler')),
+                                        ('httpd.service.conf', roles.runs(conf_dict, 'httpd')),
+                                        ('redis.service.conf', roles.runs(conf_dict, 'redis')),
+                                        ('redis-cache.service.conf', roles.runs(conf_dict, 'redis') and
+                                         conf_dict.get('redis_split'))) if used]
+    ssl_keys = ['pem_source', 'key_source'] if conf_dict['load_ssl'] and roles.runs(conf_dict, 'httpd') else []
+    return fnames, ssl_keys
+
+
+def _file_targets(conf_dict):
+    """
+    Where cloud-init writes each generated file, and its permissions. The files that would be
+    overwritten during the setup (by indico_initial_setup or the Redis package) are put at the
+    root of the filesystem instead, and moved into place by `tpl/steps/config_files.sh`.
+    """
+
+    return {
+        'indico_httpd.conf': (os.path.join(conf_dict['httpd_confd_dir'], 'indico.conf'), '0644'),
+        'indico_indico.conf': ('/indico_indico.conf', '0644'),
+        'indico_zodb.conf': ('/indico_zodb.conf', '0644'),
+        'redis.conf': ('/redis.conf', '0644'),
+        'redis-cache.conf': ('/etc/redis-cache.conf', '0644'),
+        'indico-zeo.service': ('/etc/systemd/system/indico-zeo.service', '0644'),
+        'indico-scheduler.service': ('/etc/systemd/system/indico-scheduler.service', '0644'),
+        'httpd.service.conf': ('/etc/systemd/system/httpd.service.d/indico.conf', '0644'),
+        'redis.service.conf': ('/etc/systemd/system/redis.service.d/indico.conf', '0644'),
+        'redis-cache.service.conf': ('/etc/systemd/system/redis-cache.service.d/indico.conf', '0644')
+    }
 
-def _gen_cloud_config_ssl(conf_dict):
-    with open(conf_dict['pem_source'], 'r') as f:
-        pem_content = _add_tabs(f.read())
-    with open(conf_dict['key_source'], 'r') as f:
-        key_content = _add_tabs(f.read())
 
-    in_path = os.path.join(tpl_dir, 'cloud-config-ssl')
-    out_path = os.path.join(conf_dict['build_dir'], 'cloud-config-ssl')
-    rules_dict = {
-        'pem_content': pem_content,
-        'pem_filename': os.path.basename(conf_dict['pem_source']),
-        'key_content': key_content,
-        'key_filename': os.path.basename(conf_dict['key_source'])
-    }
+def _write_files(conf_dict, rendered):
+    """
+    (path, content, permissions) of the files written by cloud-config
+    """
+
+    files = []
+    if conf_dict['enable_networking']:
+        files.append(('/etc/sysconfig/network-scripts/ifcfg-ens3', render(os.path.join(tpl_dir, 'ifcfg-ens3'), {}),
+                      '0644'))
+
+    fnames, ssl_keys = _shipped_files(conf_dict)
+    targets = _file_targets(conf_dict)
+    for fname in fnames:
+        files.append((targets[fname][0], rendered[fname], targets[fname][1]))
+
+    for key, directory, permissions in zip(ssl_keys, (conf_dict['ssl_certs_dir'], conf_dict['ssl_private_dir']),
+                                           ('0644', '0600')):
+        files.append((os.path.join(directory, os.path.basename(conf_dict[key])), _read_file(conf_dict[key]),
+                      permissions))
+
+    return files
+
+
+def _gz_b64(content):
+    buf = BytesIO()
+    # mtime is fixed so that the same content is always encoded the same way
+    gfile = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    gfile.write(content.encode('utf-8'))
+    gfile.close()
+    return base64.b64encode(buf.getvalue()).decode('ascii')
 
-    _gen_file(rules_dict, in_path, out_path)
 
+class _CloudConfigDumper(SafeDumper):
+    """
+    Writes multi-line strings as literal blocks, and a long string used several times only once
+    (the other occurrences are YAML aliases)
+    """
 
-def _gen_cloud_config(conf_dict):
-    content = {}
+    def ignore_aliases(self, data):
+        if isinstance(data, string_types) and len(data) > 64:
+            return False
+        return SafeDumper.ignore_aliases(self, data)
 
-    for fname in ['indico_httpd.conf', 'indico_indico.conf', 'redis.conf']:
-        content[fname] = _add_tabs(_read_file(os.path.join(conf_dict['build_dir'], fname)))
 
-    content['ifcfg-ens3'] = _add_tabs(_read_file(os.path.join(tpl_dir, 'ifcfg-ens3')))
+def _represent_str(dumper, data):
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|' if '\n' in data else None)
 
-    if conf_dict['load_ssl']:
-        _gen_cloud_config_ssl(conf_dict)
-        ssl_files = _read_file(os.path.join(conf_dict['build_dir'], 'cloud-config-ssl'))
+
+for _str_type in set((str, type(u''))):
+    _CloudConfigDumper.add_representer(_str_type, _represent_str)
+
+
+@build_graph.register('cloud-config', templates=['ifcfg-ens3'],
+                       keys=['stage', 'load_ssl', 'pem_source', 'key_source', 'ssh_keys', 'password', 'role',
+                             'redis_split', 'enable_networking', 'httpd_confd_dir', 'ssl_certs_dir',
+                             'ssl_private_dir', 'file_encoding'],
+                       files=['pem_source', 'key_source', 'ssh_keys'], sources=['roles.py'],
+                       deps=['indico_httpd.conf', 'indico_indico.conf', 'redis.conf', 'redis-cache.conf',
+                             'indico_zodb.conf', 'indico-zeo.service',
+                             'indico-scheduler.service', 'httpd.service.conf', 'redis.service.conf',
+                             'redis-cache.service.conf'])
+def _gen_cloud_config(conf_dict, rendered):
+    encoding = conf_dict.get('file_encoding', 'plain')
+    if encoding not in file_encodings:
+        raise ValueError("Unknown file encoding '{0}' (choose from {1})".format(
+            encoding, ', '.join(file_encodings)))
+
+    # Equal contents are the same object, so that the YAML only contains them once
+    contents = {}
+    write_files = []
+    for path, content, permissions in _write_files(conf_dict, rendered):
+        entry = {'path': path, 'owner': 'root:root', 'permissions': permissions}
+        encoded = _gz_b64(content) if encoding != 'plain' else None
+        if encoded and (encoding == 'gz+b64' or len(encoded) < len(content)):
+            entry.update(encoding='gz+b64', content=contents.setdefault(encoded, encoded))
+        else:
+            entry['content'] = contents.setdefault(content, content)
+        write_files.append(entry)
+
+    cloud_config = {'write_files': write_files}
+
+    ssh_keys = [key for key in (_get_ssh_key(k) for k in conf_dict.get('ssh_keys', [])) if key is not None]
+    if ssh_keys:
+        cloud_config['ssh_authorized_keys'] = ssh_keys
+
+    if conf_dict.get('password'):
+        cloud_config.update(password=conf_dict['password'], chpasswd={'expire': False}, ssh_pwauth=True)
+
+    if not quiet:
+        print("Generating cloud-config... ", end="")
+    content = '#cloud-config\n' + dump(cloud_config, Dumper=_CloudConfigDumper, default_flow_style=False)
+    if not quiet:
+        print(cyan("done"))
+    return content
+
+
+def _gen_config_files(conf_dict, stamps):
+    """
+    Render the files that are out of date, reuse the others
+    """
+
+    rendered, generated = artifacts.build(build_graph, conf_dict, tpl_dir, stamps)
+
+    if not quiet:
+        for fname in sorted(set(rendered) - set(generated)):
+            print("{0} is up to date".format(fname))
+
+    return rendered
+
+
+def _size_limit(conf_dict):
+    if conf_dict.get('max_size'):
+        return int(conf_dict['max_size'])
+    provider = conf_dict.get('provider')
+    if provider is None:
+        return None
+    if provider not in provider_limits:
+        raise ValueError("Unknown provider '{0}' (choose from {1})".format(
+            provider, ', '.join(sorted(provider_limits))))
+    return provider_limits[provider]
+
+
+def _size_breakdown(parts):
+    """
+    Size of every MIME part, and of every file written by the cloud-config part
+    """
+
+    breakdown = []
+    for fname, content, _ in parts:
+        breakdown.append((fname, len(content)))
+        if fname == 'cloud-config':
+            breakdown += [('  ' + entry['path'], len(entry['content']))
+                          for entry in safe_load(content).get('write_files') or []]
+    return breakdown
+
+
+def _size_report(breakdown, size, compressed, limit):
+    lines = ['{0:>8} {1}'.format(nbytes, fname) for fname, nbytes in breakdown]
+    lines.append('{0:>8} user-data{1}{2}'.format(
+        size, ' (gzip)' if compressed else '',
+        ' / {0} allowed'.format(limit) if limit else ''))
+    return '\n'.join(lines)
+
+
+def _encode_user_data(conf_dict, parts, boundary):
+    """
+    Build the user-data, compressing it if needed (or asked to), and make
+    sure it fits into the size budget of the provider
+    """
+
+    compress = conf_dict.get('compress', 'auto')
+    if compress not in compress_modes:
+        raise ValueError("Unknown compress mode '{0}' (choose from {1})".format(compress, ', '.join(compress_modes)))
+    limit = _size_limit(conf_dict)
+    outer = build_multipart(parts, boundary=boundary)
+    data = encode_multipart(outer)
+
+    if compress == 'always' or (compress == 'auto' and limit is not None and len(data) > limit):
+        data = encode_multipart(outer, compress=True)
+        compressed = True
     else:
-        ssl_files = ''
+        compressed = False
 
-    key_list = conf_dict.get('ssh_keys', [])
-    password = conf_dict.get('password')
+    report = _size_report(_size_breakdown(parts), len(data), compressed, limit)
 
-    ssh_key_data = '\n'.join('  - {0}'.format(key) for key in (_get_ssh_key(k) for k in key_list) if key is not None)
+    if limit is not None and len(data) > limit:
+        raise ValueError("user-data for '{0}' is too large:\n{1}".format(conf_dict['host_name'], report))
 
-    if ssh_key_data:
-        ssh_key_data = "ssh_authorized_keys:\n{0}".format(ssh_key_data)
+    return data, compressed, report
 
-    in_path = os.path.join(tpl_dir, 'cloud-config')
-    out_path = os.path.join(conf_dict['build_dir'], 'cloud-config')
 
-    rules_dict = {
-        'indico_httpd_conf_content': content['indico_httpd.conf'],
-        'indico_indico_conf_content': content['indico_indico.conf'],
-        'redis_conf_content': content['redis.conf'],
-        'ifcfg_ens3_content': content['ifcfg-ens3'],
-        'ssl_files': ssl_files,
-        'ssh_key_data': ssh_key_data,
-        'password': """password: {0}
-chpasswd:
-  - expire: False
-ssh_pwauth: True
-""".format(password) if password else ''
+def _user_data_stamp(conf_dict, stamps, parts):
+    inputs = [stamps[fname] for fname, _, _ in parts]
+    inputs += [conf_dict.get('compress', 'auto'), _size_limit(conf_dict)]
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+
+def _reuse_user_data(stamps, stamp, output):
+    """
+    Return the existing output if it was generated from the same inputs
+    """
+
+    previous = stamps.get('user-data')
+    if not previous or previous['stamp'] != stamp or previous['output'] != output or not os.path.isfile(output):
+        return None
+
+    with open(output, 'rb') as f:
+        data = f.read()
+
+    if hashlib.sha1(data).hexdigest() != previous['sha1']:
+        return None
+    return data, previous['compressed']
+
+
+def _gen_user_data(conf_dict, output):
+    build_dir = conf_dict['build_dir']
+    if not os.path.exists(build_dir):
+        os.makedirs(build_dir)
+
+    stamps = artifacts.load_stamps(build_dir)
+    rendered = _gen_config_files(conf_dict, stamps)
+    parts = [(fname, rendered[fname], None) for fname in ('user-data-script.sh', 'cloud-config')]
+
+    stamp = _user_data_stamp(conf_dict, stamps, parts)
+    reused = _reuse_user_data(stamps, stamp, output)
+    if reused:
+        if not quiet:
+            print("{0} is up to date".format(output))
+        artifacts.save_stamps(build_dir, stamps)
+        return reused
+
+    # The boundary is derived from the inputs, so that the output is deterministic
+    boundary = '==============={0}=='.format(stamp)
+    data, compressed, report = _encode_user_data(conf_dict, parts, boundary)
+
+    if not quiet:
+        print(report)
+
+    with open(output, 'wb') as f:
+        f.write(data)
+
+    stamps['user-data'] = {
+        'stamp': stamp,
+        'output': output,
+        'sha1': hashlib.sha1(data).hexdigest(),
+        'compressed': compressed
+    }
+    artifacts.save_stamps(build_dir, stamps)
+
+    return data, compressed
+
+
+def _fleet_worker_init():
+    global quiet
+    quiet = True
+
+
+def _gen_fleet_instance(args):
+    conf_dict, output = args
+    data, compressed = _gen_user_data(conf_dict, output)
+
+    return {
+        'host_name': conf_dict['host_name'],
+        'role': roles.role(conf_dict),
+        'build_dir': conf_dict['build_dir'],
+        'output': output,
+        'size': len(data),
+        'compressed': compressed,
+        'sha1': hashlib.sha1(data).hexdigest()
     }
 
-    _gen_file(rules_dict, in_path, out_path)
 
+def _fleet_jobs(fleet_dict, output_dir, overrides):
+    """
+    Merge the shared defaults with each instance's overrides. Every instance
+    gets its own build directory, so that they can be generated concurrently.
+    """
+
+    build_dir = fleet_dict.get('build_dir', '../build')
+    defaults = fleet_dict.get('defaults', {})
+    jobs = []
+    seen = set()
+
+    for instance in fleet_dict['instances']:
+        conf_dict = copy.deepcopy(defaults)
+        conf_dict.update(instance)
+        conf_dict.update(overrides)
+
+        host_name = conf_dict.get('host_name')
+        if not host_name:
+            raise ValueError("Every fleet instance needs a 'host_name'")
+        if host_name in seen:
+            raise ValueError("Duplicate fleet instance '{0}'".format(host_name))
+        seen.add(host_name)
+
+        conf_dict['build_dir'] = os.path.join(build_dir, host_name)
+        output = conf_dict.pop('output', os.path.join(output_dir, '{0}.user-data'.format(host_name)))
+        jobs.append((conf_dict, output))
+
+    # Split deployments: point the web and scheduler nodes to the db and redis nodes
+    roles.wire_fleet([conf_dict for conf_dict, output in jobs])
+
+    return jobs
+
+
+def gen_fleet(fleet_dict, output_dir, processes=None, overrides=None):
+    jobs = _fleet_jobs(fleet_dict, output_dir, overrides or {})
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    print("Generating {0} instances...".format(len(jobs)))
+    pool = multiprocessing.Pool(processes, _fleet_worker_init)
+    try:
+        manifest = pool.map(_gen_fleet_instance, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    manifest_path = os.path.join(output_dir, 'manifest.yaml')
+    with open(manifest_path, 'w') as f:
+        dump({'instances': manifest}, f, default_flow_style=False)
+
+    return manifest_path
+
+
+def validate_instance(conf_dict):
+    """
+    Render every file of an instance in memory (nothing is written) and check it
+    """
+
+    report = validate.Report(conf_dict.get('host_name') or '<no host_name>')
+    rendered, failed = artifacts.render(build_graph, conf_dict)
+    for artifact in build_graph.artifacts:
+        e = failed.get(artifact.name)
+        if isinstance(e, KeyError) and e.args[0] in artifact.keys:
+            report.error(artifact.name, "missing configuration key '{0}'".format(e.args[0]))
+        elif isinstance(e, KeyError):
+            report.error(artifact.name, e.args[0])
+        elif e is not None:
+            report.error(artifact.name, str(e))
 
-def _gen_config_files(conf_dict):
-    _gen_indico_httpd_conf(conf_dict)
-    _gen_indico_indico_conf(conf_dict)
-    _gen_redis_conf(conf_dict)
-    _gen_script(conf_dict)
-    _gen_cloud_config(conf_dict)
+    fnames, ssl_keys = _shipped_files(conf_dict) if 'load_ssl' in conf_dict else ([], [])
+    # Only the files which were rendered can be checked (the failures are reported above)
+    fnames = [fname for fname in fnames if fname in rendered]
+
+    if 'cloud-config' in rendered:
+        expected = dict((path, (content, permissions))
+                        for path, content, permissions in _write_files(conf_dict, rendered))
+        validate.cloud_config(report, rendered['cloud-config'], expected)
+
+        # Otherwise the size limit (if any) is the only thing left to check
+        parts = [(fname, rendered[fname], None) for fname in ('user-data-script.sh', 'cloud-config')
+                 if fname in rendered]
+        try:
+            _encode_user_data(conf_dict, parts, '===============validate==')
+        except ValueError as e:
+            report.error('user-data', str(e).splitlines()[0])
+
+    for fname in conf_dict.get('ssh_keys') or []:
+        if not re.match(ssh_key_re, _read_file(fname).strip()):
+            report.error(fname, 'not a valid SSH public key')
+
+    if 'user-data-script.sh' in rendered:
+        validate.shell_script(report, 'user-data-script.sh', rendered['user-data-script.sh'])
+
+    if 'indico_httpd.conf' in fnames:
+        validate.apache_conf(report, 'indico_httpd.conf', rendered['indico_httpd.conf'])
+
+    redis_confs = [validate.redis_conf(report, fname, rendered[fname])
+                   for fname in ('redis.conf', 'redis-cache.conf') if fname in fnames]
+    if len(redis_confs) == 2:
+        for directive in ('port', 'unixsocket', 'pidfile', 'dbfilename'):
+            if directive in redis_confs[0] and redis_confs[0].get(directive) == redis_confs[1].get(directive):
+                report.error('redis-cache.conf', "same '{0}' as the main instance".format(directive))
+
+    if ssl_keys:
+        validate.ssl_pair(report, conf_dict['pem_source'], conf_dict['key_source'])
+
+    return report
+
+
+def validate_configs(conf_dicts):
+    """
+    Check every instance and print the problems found, returns whether all of them are valid
+    """
+
+    global quiet
+    quiet = True
+
+    valid = True
+    for conf_dict in conf_dicts:
+        start = time.time()
+        report = validate_instance(conf_dict)
+        elapsed = time.time() - start
+
+        for warning in report.warnings:
+            print(yellow("{0}: {1}".format(report.name, warning)))
+        if report.errors:
+            valid = False
+            print(red("{0}: {1} problem(s)".format(report.name, len(report.errors))))
+            for error in report.errors:
+                print("  {0}".format(error))
+        else:
+            print(green("{0}: OK ({1:.2f}s)".format(report.name, elapsed)))
+
+    return valid
 
 
 def main():
     parser = argparse.ArgumentParser(description='Generate user-data file for cloud deployment of Indico.')
     parser.add_argument('--config', metavar='FILE', help='use an existing config file (YAML)')
     parser.add_argument('--output', metavar='FILE', default='user-data', help="output file (default: 'user-data')")
+    parser.add_argument('--fleet', metavar='FILE',
+                        help='generate one user-data file per instance listed in a fleet file (YAML)')
+    parser.add_argument('--output-dir', metavar='DIR', default='fleet',
+                        help="output directory in fleet mode (default: 'fleet')")
+    parser.add_argument('--jobs', metavar='N', type=int, default=None,
+                        help='number of parallel processes in fleet mode (default: number of CPUs)')
+    parser.add_argument('--provider', choices=sorted(provider_limits),
+                        help='enforce the user-data size limit of a cloud provider')
+    parser.add_argument('--max-size', metavar='BYTES', type=int, help='enforce a custom user-data size limit')
+    parser.add_argument('--compress', choices=compress_modes,
+                        help="gzip the user-data ('auto' only does it if it would exceed the size limit)")
+    parser.add_argument('--sizing', choices=['auto'] + sorted(sizing.PROFILES),
+                        help="size the services for a profile, or at boot time according to the instance ('auto')")
+    parser.add_argument('--prefetch', metavar='DIR',
+                        help='download the packages needed by the instances into a local mirror and exit')
+    parser.add_argument('--role', choices=roles.ROLES,
+                        help="only set up some of the components of a split deployment (default: 'all')")
+    parser.add_argument('--stage', choices=stages,
+                        help="'bake' a golden image, 'personalize' an instance of it or do everything (default: 'full')")
+    parser.add_argument('--validate', action='store_true',
+                        help='only check the files that would be generated (nothing is written)')
 
     args = parser.parse_args()
 
-    if args.config:
-        with open(args.config, 'r') as f:
-            conf_dict = load(f)
-    else:
-        conf_dict = config()
+    # Command-line options take precedence over the config files
+    overrides = dict((k, v) for k, v in (('provider', args.provider),
+                                         ('max_size', args.max_size),
+                                         ('compress', args.compress),
+                                         ('stage', args.stage),
+                                         ('role', args.role),
+                                         ('sizing', args.sizing)) if v is not None)
+
+    if args.prefetch:
+        mirror.prefetch(args.prefetch, yum_packages, python_packages)
+        print(green("Populated mirror '{0}'.".format(args.prefetch)))
+        return
+
+    try:
+        if args.fleet:
+            with open(args.fleet, 'r') as f:
+                fleet_dict = load(f)
+            if args.validate:
+                jobs = _fleet_jobs(fleet_dict, args.output_dir, overrides)
+                sys.exit(0 if validate_configs([conf_dict for conf_dict, output in jobs]) else 1)
+            manifest_path = gen_fleet(fleet_dict, args.output_dir, args.jobs, overrides)
+            print(green("Wrote '{0}'.".format(manifest_path)))
+            return
+
+        if args.config:
+            with open(args.config, 'r') as f:
+                conf_dict = load(f)
+        else:
+            conf_dict = config()
+        conf_dict.update(overrides)
+
+        if args.validate:
+            sys.exit(0 if validate_configs([conf_dict]) else 1)
+
+        _gen_user_data(conf_dict, args.output)
+    except ValueError as e:
+        print(red(str(e)))
+        sys.exit(1)
 
-    _gen_config_files(conf_dict)
-    os.system("./write-mime-multipart --output {0}".format(args.output)
-              + " {0}".format(os.path.join(conf_dict['build_dir'], 'user-data-script.sh'))
-              + " {0}".format(os.path.join(conf_dict['build_dir'], 'cloud-config'))
-              )
     print(green("Wrote '{0}'.".format(args.output)))
 
 
@@ -0,0 +1,85 @@
+"""
+Local artifact cache, so that instances can be provisioned without
+downloading anything from the internet.
+
+The cache directory contains a yum repository (`rpms/`) and the wheels
+needed by the Indico virtualenv (`wheels/`). It can be served over HTTP
+or attached to the VM as a data disk (see `mirror_url` and
+`mirror_disk_label`).
+
+Since the wheels are built for the current platform, the cache must be
+populated from a machine running the same OS as the instances (CentOS 7).
+The RPMs are downloaded with all their dependencies, including the ones
+installed on that machine, and without changing its repositories.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+# Mount point of the mirror disk on the instances
+DISK_MOUNT_POINT = '/mnt/indico-mirror'
+
+EPEL_RELEASE_URL = 'http://dl.fedoraproject.org/pub/epel/7/x86_64/e/epel-release-7-2.noarch.rpm'
+
+
+def mirror_settings(conf_dict):
+    """
+    Return whether the mirror is used, and its URL as seen from the instance
+    """
+
+    mirror_url = conf_dict.get('mirror_url')
+    if not mirror_url and conf_dict.get('mirror_disk_label'):
+        mirror_url = 'file://' + DISK_MOUNT_POINT
+    return bool(mirror_url), (mirror_url or '').rstrip('/')
+
+
+def _epel_repos(rpms_dir, tmp_dir):
+    """
+    Download the EPEL release RPM into the cache, and extract its repository definitions
+    (instead of installing it on this machine)
+    """
+
+    rpm_path = os.path.join(rpms_dir, os.path.basename(EPEL_RELEASE_URL))
+    if not os.path.exists(rpm_path):
+        response = urlopen(EPEL_RELEASE_URL, timeout=60)
+        try:
+            with open(rpm_path, 'wb') as f:
+                shutil.copyfileobj(response, f)
+        finally:
+            response.close()
+
+    subprocess.check_call('rpm2cpio "{0}" | cpio -idm --quiet'.format(rpm_path), shell=True, cwd=tmp_dir)
+    return os.path.join(tmp_dir, 'etc', 'yum.repos.d')
+
+
+def prefetch(cache_dir, yum_packages, python_packages):
+    rpms_dir = os.path.join(cache_dir, 'rpms')
+    wheels_dir = os.path.join(cache_dir, 'wheels')
+
+    for d in (rpms_dir, wheels_dir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # EPEL provides some of the packages (e.g. Redis), it is only enabled for the download
+        yum_conf = os.path.join(tmp_dir, 'yum.conf')
+        with open(yum_conf, 'w') as f:
+            f.write('[main]\ncachedir={0}\nreposdir=/etc/yum.repos.d {1}\n'.format(
+                os.path.join(tmp_dir, 'cache'), _epel_repos(rpms_dir, tmp_dir)))
+
+        # Unlike `yumdownloader --resolve`, repotrack also fetches the dependencies installed here
+        subprocess.check_call(['repotrack', '-c', yum_conf, '-a', 'x86_64', '-p', rpms_dir] + yum_packages)
+    finally:
+        shutil.rmtree(tmp_dir)
+    subprocess.check_call(['createrepo', '--update', rpms_dir])
+
+    subprocess.check_call(['pip', 'wheel', '--wheel-dir', wheels_dir, 'pip', 'setuptools'] + python_packages)
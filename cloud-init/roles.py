@@ -0,0 +1,134 @@
+"""
+Roles of the instances in a split deployment.
+
+By default an instance runs everything ('all'). Otherwise, a deployment
+consists of N 'web' nodes, one 'db' (ZEO) node, one 'redis' node and one
+'scheduler' node, which are wired together by `wire_fleet`.
+"""
+
+
+# Components run by each role
+COMPONENTS = {
+    'all': ('redis', 'db', 'httpd', 'scheduler'),
+    'web': ('httpd',),
+    'db': ('db',),
+    'redis': ('redis',),
+    'scheduler': ('scheduler',)
+}
+
+ROLES = tuple(sorted(COMPONENTS))
+
+# Ports opened to everyone / to the other nodes of the cluster
+PUBLIC_PORTS = {
+    'httpd': (80, 443)
+}
+CLUSTER_PORTS = {
+    'db': ('db_port', 9675),
+    'redis': ('redis_port', 6379)
+}
+
+# Settings of the db and redis nodes that their clients must share (with their defaults)
+SERVED_KEYS = {
+    'db': (('db_port', 9675),),
+    'redis': (('redis_port', None), ('redis_pswd', None), ('redis_split', False), ('redis_cache_port', 6380))
+}
+
+
+def role(conf_dict):
+    name = conf_dict.get('role', 'all')
+    if name not in COMPONENTS:
+        raise ValueError("Unknown role '{0}' (choose from {1})".format(name, ', '.join(ROLES)))
+    return name
+
+
+def runs(conf_dict, *components):
+    return any(c in COMPONENTS[role(conf_dict)] for c in components)
+
+
+def runs_indico(conf_dict):
+    return runs(conf_dict, 'db', 'httpd', 'scheduler')
+
+
+def packages(conf_dict, all_packages):
+    if not runs(conf_dict, 'redis'):
+        all_packages = [p for p in all_packages if p != 'redis']
+    if not runs_indico(conf_dict):
+        all_packages = [p for p in all_packages if p in ('iptables-services', 'redis')]
+    return all_packages
+
+
+def firewall_rules(conf_dict):
+    """
+    The whole INPUT chain: everything which isn't explicitly allowed is rejected
+    """
+
+    rules = ['iptables -F INPUT',
+             'iptables -A INPUT -i lo -j ACCEPT',
+             'iptables -A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT',
+             'iptables -A INPUT -p icmp -j ACCEPT',
+             'iptables -A INPUT -p tcp -m tcp --dport 22 -j ACCEPT']
+    source = ' -s {0}'.format(conf_dict['cluster_network']) if conf_dict.get('cluster_network') else ''
+
+    for component in COMPONENTS[role(conf_dict)]:
+        for port in PUBLIC_PORTS.get(component, ()):
+            rules.append('iptables -A INPUT -p tcp -m tcp --dport {0} -j ACCEPT'.format(port))
+        # Only needed if other nodes connect to this one
+        if component in CLUSTER_PORTS and role(conf_dict) != 'all':
+            # ZEO has no authentication, so it must never be reachable from everywhere
+            if not source:
+                raise ValueError("A '{0}' node needs a 'cluster_network'".format(role(conf_dict)))
+            key, default = CLUSTER_PORTS[component]
+            ports = [conf_dict.get(key, default)]
+            if component == 'redis' and conf_dict.get('redis_split'):
+                ports.append(conf_dict.get('redis_cache_port', 6380))
+            for port in ports:
+                rules.append('iptables -A INPUT{0} -p tcp -m tcp --dport {1} -j ACCEPT'.format(source, port))
+
+    rules.append('iptables -A INPUT -j REJECT --reject-with icmp-host-prohibited')
+    return '\n'.join(rules)
+
+
+def _use_node(conf_dict, node, component):
+    """
+    Take the settings of the node serving `component`, which must not contradict the client's own
+    """
+
+    for key, default in SERVED_KEYS[component]:
+        value = node.get(key, default)
+        if key in conf_dict and conf_dict[key] != value:
+            raise ValueError("'{0}' has a different '{1}' than the '{2}' node '{3}'".format(
+                conf_dict['host_name'], key, component, node['host_name']))
+        elif value is not None:
+            conf_dict[key] = value
+
+
+def wire_fleet(confs):
+    """
+    Point the nodes of a split deployment to the db and redis nodes (unless
+    they already use a remote one), with the same ports and password, and
+    make those listen on the network
+    """
+
+    nodes = {}
+    for conf_dict in confs:
+        name = role(conf_dict)
+        if name in ('db', 'redis', 'scheduler'):
+            if name in nodes:
+                raise ValueError("Only one '{0}' node is supported".format(name))
+            nodes[name] = conf_dict
+
+    for conf_dict in confs:
+        name = role(conf_dict)
+        if name == 'all':
+            continue
+        for component, host_key, bind_key in (('db', 'db_host', 'db_bind'), ('redis', 'redis_host', 'redis_bind')):
+            if component in nodes:
+                node = nodes[component]
+                if conf_dict is node:
+                    conf_dict.setdefault(bind_key, '0.0.0.0')
+                elif conf_dict.get(host_key, 'localhost') in ('localhost', node['host_name']):
+                    conf_dict[host_key] = node['host_name']
+                    _use_node(conf_dict, node, component)
+            elif conf_dict.get(host_key, 'localhost') == 'localhost':
+                raise ValueError("'{0}' needs a '{1}' node or an explicit '{2}'".format(
+                    conf_dict['host_name'], component, host_key))
@@ -0,0 +1,155 @@
+"""
+Sizing of the services according to the resources of the instance.
+
+The settings can be computed when generating the user-data (from a profile
+or explicit `cpus`/`ram_mb` values), or on the instance itself at boot time
+(`sizing: auto`): in that case the templates are rendered with placeholder
+tokens, and this very module is embedded in the user-data script in order
+to replace them with values computed from the detected resources.
+"""
+
+import os
+import sys
+
+
+PROFILES = {
+    'small': {'cpus': 1, 'ram_mb': 1024},
+    'medium': {'cpus': 2, 'ram_mb': 4096},
+    'large': {'cpus': 4, 'ram_mb': 8192},
+    'xlarge': {'cpus': 8, 'ram_mb': 16384}
+}
+
+# Used if no sizing is specified (what the templates used to hardcode)
+DEFAULTS = {
+    'wsgi_processes': 32,
+    'wsgi_threads': 1,
+    'wsgi_maximum_requests': 10000,
+    'redis_maxmemory': '0',
+    'redis_cache_maxmemory': '256mb',
+    'redis_maxmemory_policy': 'volatile-lru',
+    'zeo_invalidation_queue_size': 100
+}
+
+# Approximate memory usage of the different components (MB)
+OS_RESERVED_MB = 384
+WSGI_PROCESS_MB = 150
+
+
+def compute(cpus, ram_mb, redis_split=False):
+    # Redis gets 1/8 of the memory, and only evicts keys with an expiration (i.e. not the sessions)
+    redis_mb = max(64, ram_mb // 8)
+    available_mb = max(0, ram_mb - OS_RESERVED_MB - redis_mb)
+
+    # A separate cache instance takes half of it
+    cache_mb = redis_mb // 2
+    if redis_split:
+        redis_mb -= cache_mb
+
+    # Indico is mostly I/O bound, so a few processes per CPU, as long as they fit in memory
+    processes = max(2, min(cpus * 4, available_mb // WSGI_PROCESS_MB))
+
+    # If memory is the limit, compensate with threads
+    threads = 1 if processes >= cpus * 2 else 2
+
+    # Recycle processes more often when memory is scarce
+    if ram_mb < 2048:
+        maximum_requests = 2000
+    elif ram_mb < 8192:
+        maximum_requests = 5000
+    else:
+        maximum_requests = 10000
+
+    # Clients that were disconnected for less than the queue only need to verify what changed
+    # (instead of their whole cache), which is worth the memory on bigger machines
+    invalidation_queue_size = max(100, min(10000, ram_mb // 4))
+
+    return {
+        'wsgi_processes': processes,
+        'wsgi_threads': threads,
+        'wsgi_maximum_requests': maximum_requests,
+        'redis_maxmemory': '{0}mb'.format(redis_mb),
+        'redis_cache_maxmemory': '{0}mb'.format(cache_mb),
+        'redis_maxmemory_policy': 'volatile-lru',
+        'zeo_invalidation_queue_size': invalidation_queue_size
+    }
+
+
+def split_wsgi_groups(values, groups):
+    """
+    Share the WSGI processes among `groups` daemon groups, recycled after different numbers of
+    requests so that their processes don't all restart (and load Indico again) at the same time
+    """
+
+    processes = max(int(values['wsgi_processes']), groups)
+    maximum_requests = int(values['wsgi_maximum_requests'])
+    for i in range(groups):
+        values['wsgi_processes_{0}'.format(i)] = processes // groups + (1 if i < processes % groups else 0)
+        values['wsgi_maximum_requests_{0}'.format(i)] = maximum_requests + maximum_requests * i // (2 * groups)
+    return values
+
+
+def token(key):
+    return '@@{0}@@'.format(key.upper())
+
+
+def settings(conf_dict):
+    """
+    Sizing settings for the templates
+    """
+
+    sizing = conf_dict.get('sizing')
+    groups = int(conf_dict.get('wsgi_groups', 1))
+
+    if sizing == 'auto':
+        return dict((key, token(key)) for key in split_wsgi_groups(dict(DEFAULTS), groups))
+    elif sizing:
+        if sizing not in PROFILES:
+            raise ValueError("Unknown sizing profile '{0}' (choose from 'auto', {1})".format(
+                sizing, ', '.join(sorted(PROFILES))))
+        resources = dict(PROFILES[sizing])
+    elif conf_dict.get('cpus') or conf_dict.get('ram_mb'):
+        resources = {'cpus': 1, 'ram_mb': 1024}
+    else:
+        return split_wsgi_groups(dict(DEFAULTS), groups)
+
+    for key in ('cpus', 'ram_mb'):
+        if conf_dict.get(key):
+            resources[key] = int(conf_dict[key])
+
+    values = compute(resources['cpus'], resources['ram_mb'], bool(conf_dict.get('redis_split')))
+    return split_wsgi_groups(values, groups)
+
+
+def detect():
+    cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return cpus, int(line.split()[1]) // 1024
+    raise RuntimeError("Can't find the amount of memory")
+
+
+def apply_detected(paths, redis_split=False, wsgi_groups=1):
+    """
+    Replace the tokens in `paths` with values computed for this machine
+    """
+
+    cpus, ram_mb = detect()
+    values = split_wsgi_groups(compute(cpus, ram_mb, redis_split), wsgi_groups)
+    print('Sizing for {0} CPUs and {1} MB: {2}'.format(cpus, ram_mb, values))
+
+    for path in paths:
+        # Depending on its role, the instance may not have all the files
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            content = f.read()
+        for key, value in values.items():
+            content = content.replace(token(key), str(value))
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+if __name__ == '__main__':
+    # sizing.py REDIS_SPLIT WSGI_GROUPS PATH...
+    apply_detected(sys.argv[3:], sys.argv[1] == 'true', int(sys.argv[2]))
@@ -0,0 +1,68 @@
+"""
+Compiled templates for the files in `tpl/`.
+
+Templates use the `str.format` syntax. Each one is parsed only once (and
+parsed again only if the file changes on disk), which avoids re-reading and
+re-parsing the same templates over and over when generating many instances.
+"""
+
+import hashlib
+import os
+from string import Formatter
+
+
+_formatter = Formatter()
+_cache = {}
+
+
+class Template(object):
+    def __init__(self, source, name='<string>'):
+        self.name = name
+        self.digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        self._chunks = []
+        placeholders = set()
+
+        for literal, field, spec, conversion in _formatter.parse(source):
+            if field is not None:
+                root = field.split('.', 1)[0].split('[', 1)[0]
+                if not root or root.isdigit():
+                    raise ValueError("Positional placeholder in template '{0}'".format(name))
+                placeholders.add(root)
+            self._chunks.append((literal, field, spec, conversion))
+
+        self.placeholders = frozenset(placeholders)
+
+    def render(self, rules_dict):
+        missing = self.placeholders.difference(rules_dict)
+        if missing:
+            raise KeyError("Missing values for template '{0}': {1}".format(
+                self.name, ', '.join(sorted(missing))))
+
+        buf = []
+        for literal, field, spec, conversion in self._chunks:
+            buf.append(literal)
+            if field is not None:
+                obj = _formatter.get_field(field, (), rules_dict)[0]
+                obj = _formatter.convert_field(obj, conversion)
+                buf.append(_formatter.format_field(obj, spec))
+        return ''.join(buf)
+
+
+def get_template(path):
+    """
+    Return the compiled template for `path`, from the cache if it's up to date
+    """
+
+    mtime = os.path.getmtime(path)
+    cached = _cache.get(path)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as f:
+            cached = (mtime, Template(f.read(), os.path.basename(path)))
+        _cache[path] = cached
+
+    return cached[1]
+
+
+def render(path, rules_dict):
+    return get_template(path).render(rules_dict)
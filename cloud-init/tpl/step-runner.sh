@@ -0,0 +1,78 @@
+# Run every step as soon as its dependencies are done, several at a time. The output
+# of each step is logged separately, and the steps completed by a previous run (of
+# the same stage) are skipped.
+state_dir=/var/lib/indico-cloud-init/{stage}
+log_dir=/var/log/indico-cloud-init
+mkdir -p $state_dir $log_dir
+: > $log_dir/durations
+
+steps=({step_names})
+declare -A deps state pids
+{step_deps}
+
+function run_step(){{
+    local name=$1
+    local start=$(date +%s.%N)
+    echo "indico-cloud-init: step $name $start"
+    ( step_$name ) 2>&1 | tee $log_dir/$name.log
+    local rc=${{PIPESTATUS[0]}}
+    local end=$(date +%s.%N)
+    echo "$name $rc $start $end" >> $log_dir/durations
+    if [ $rc -eq 0 ]; then
+        touch $state_dir/$name.done
+    else
+        echo "indico-cloud-init: failed step $name ($rc), see $log_dir/$name.log"
+    fi
+    echo "indico-cloud-init: finished step $name $end"
+}}
+
+for name in "${{steps[@]}}"; do
+    if [ -e $state_dir/$name.done ]; then
+        echo "indico-cloud-init: skipping step $name (already done)"
+        state[$name]=done
+    else
+        state[$name]=pending
+    fi
+done
+
+while true; do
+    running=0
+    for name in "${{steps[@]}}"; do
+        if [ "${{state[$name]}}" = running ]; then
+            if kill -0 ${{pids[$name]}} 2>/dev/null; then
+                running=$((running + 1))
+            else
+                # Like the serial script, a failed step doesn't stop the others
+                wait ${{pids[$name]}}
+                state[$name]=done
+            fi
+        fi
+    done
+
+    started=0
+    for name in "${{steps[@]}}"; do
+        if [ "${{state[$name]}}" != pending ]; then
+            continue
+        fi
+        ready=true
+        for dep in ${{deps[$name]}}; do
+            if [ "${{state[$dep]}}" != done ]; then
+                ready=false
+            fi
+        done
+        if $ready; then
+            run_step $name &
+            pids[$name]=$!
+            state[$name]=running
+            started=$((started + 1))
+        fi
+    done
+
+    if [ $running -eq 0 ] && [ $started -eq 0 ]; then
+        break
+    fi
+    sleep 0.2
+done
+
+echo "indico-cloud-init: duration of the steps"
+awk '{{ printf "    %-16s %8.1fs%s\n", $1, $4 - $3, ($2 != 0 ? " (failed)" : "") }}' $log_dir/durations
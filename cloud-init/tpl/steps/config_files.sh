@@ -0,0 +1,15 @@
+# Move the config files that the setup would have overwritten to their places (each role
+# only gets the ones it uses, the others are written in place by cloud-init)
+if {run_httpd}; then
+    echo '# Nothing to see here' > /etc/httpd/conf.d/welcome.conf
+fi
+if [ -f /indico_indico.conf ]; then
+    mkdir -p {indico_inst_dir}/etc
+    mv -f /indico_indico.conf {indico_inst_dir}/etc/indico.conf
+fi
+if [ -f /indico_zodb.conf ]; then
+    mv -f /indico_zodb.conf {indico_inst_dir}/etc/zodb.conf
+fi
+if [ -f /redis.conf ]; then
+    mv -f /redis.conf /etc/redis.conf
+fi
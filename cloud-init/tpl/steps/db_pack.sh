@@ -0,0 +1,4 @@
+# Pack the database regularly, keeping {db_pack_days} days of history
+cat > /etc/cron.d/indico-zeopack <<EOF
+{db_pack_schedule} apache {indico_inst_dir}/env/bin/zeopack -d {db_pack_days} {zeopack_address} >> {indico_inst_dir}/log/zeopack.log 2>&1
+EOF
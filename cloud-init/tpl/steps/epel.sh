@@ -0,0 +1,7 @@
+if ! {use_mirror}; then
+    # Install EPEL 7 (needed for Redis)
+    yum -y install wget
+    wget http://dl.fedoraproject.org/pub/epel/7/x86_64/e/epel-release-7-2.noarch.rpm
+    rpm -Uvh epel-release-7*.rpm
+    rm epel-release-7*.rpm
+fi
@@ -0,0 +1,7 @@
+# Configure Apache HTTPD
+find_replace {httpd_conf_dir}/httpd.conf '#ServerName.*' "ServerName {host_name}"
+
+if [ -n "{ssl_session_cache}" ]; then
+    # The session cache is defined in Indico's configuration
+    find_replace {httpd_confd_dir}/ssl.conf '^SSLSessionCache(Timeout)? ' '#&'
+fi
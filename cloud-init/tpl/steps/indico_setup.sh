@@ -0,0 +1,3 @@
+# Configure Indico
+. {indico_inst_dir}/env/bin/activate
+echo -e "{indico_inst_dir}\nc\ny\n{db_inst_dir}" | indico_initial_setup
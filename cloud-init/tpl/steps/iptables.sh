@@ -0,0 +1,5 @@
+# Set up iptables
+{firewall_rules}
+
+service iptables save
+service iptables restart
@@ -0,0 +1,15 @@
+if {use_mirror}; then
+    # Use the local mirror instead of the internet (see '--prefetch')
+    if [ -n "{mirror_disk_label}" ]; then
+        mkdir -p /mnt/indico-mirror
+        mount -o ro /dev/disk/by-label/{mirror_disk_label} /mnt/indico-mirror
+    fi
+
+    cat > /etc/yum.repos.d/indico-mirror.repo <<EOF
+[indico-mirror]
+name=Indico local mirror
+baseurl={mirror_url}/rpms
+enabled=1
+gpgcheck=0
+EOF
+fi
@@ -0,0 +1,4 @@
+if {enable_networking}; then
+    # Enable networking (CentOS 7 cloud images), ifcfg-ens3 is written by cloud-init
+    service network restart
+fi
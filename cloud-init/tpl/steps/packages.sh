@@ -0,0 +1,2 @@
+# Install RHEL/CentOS dependencies
+yum -y {yum_opts}install {yum_packages}
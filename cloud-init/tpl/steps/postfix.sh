@@ -0,0 +1,5 @@
+# Setup postfix if needed
+if {postfix}; then
+    echo "resolve_numeric_domain = yes" >> /etc/postfix/main.cf
+    find_replace /etc/postfix/master.cf ".*      inet  n       -       n       -       -       smtpd" "{smtp_server_port}      inet  n       -       n       -       -       smtpd"
+fi
@@ -0,0 +1,13 @@
+# Install Python dependencies and Indico
+. {indico_inst_dir}/env/bin/activate
+if {use_mirror}; then
+    pip install --no-index --find-links={mirror_url}/wheels --upgrade pip setuptools
+    pip install --no-index --find-links={mirror_url}/wheels {python_packages}
+else
+    for pkg in {python_packages}; do
+        easy_install --always-unzip $pkg
+    done
+fi
+
+# Silly hack, due to some eggs modifying themselves in run-time
+chown -R apache:apache {indico_inst_dir}/env/lib/python2.7/site-packages/
@@ -0,0 +1,9 @@
+# Second Redis instance (cache), and access to the Unix sockets
+if {redis_split}; then
+    sed -e 's|/etc/redis.conf|/etc/redis-cache.conf|g' -e 's|^Description=.*|Description=Redis cache|' \
+        -e 's|^ExecStop=/usr/libexec/redis-shutdown$|& redis-cache|' \
+        /usr/lib/systemd/system/redis.service > /etc/systemd/system/redis-cache.service
+fi
+if {redis_unix_socket}; then
+    usermod -a -G redis apache
+fi
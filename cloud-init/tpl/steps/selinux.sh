@@ -0,0 +1,10 @@
+# Properly configure SELinux
+
+for idir in 'archive' 'cache' 'htdocs' 'log' 'tmp'
+do
+    semanage fcontext -a -t httpd_sys_content_t "{indico_inst_dir}/$idir(/.*)?"
+done
+semanage fcontext -a -t httpd_sys_content_t "{db_inst_dir}(/.*)?"
+restorecon -Rv {indico_inst_dir}
+restorecon -Rv {db_inst_dir}
+setsebool -P httpd_can_network_connect 1
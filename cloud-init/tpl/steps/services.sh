@@ -0,0 +1,2 @@
+# Start the Indico services of this role (pre-baked image), systemd orders them
+systemctl restart {units}
@@ -0,0 +1,4 @@
+# Size the services according to the resources of this machine
+python - {redis_split} {wsgi_groups} {sizing_paths} <<'EOF'
+{sizing_module}
+EOF
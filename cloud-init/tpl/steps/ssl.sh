@@ -0,0 +1,7 @@
+mkdir -p {ssl_certs_dir}
+mkdir -p {ssl_private_dir}
+
+# A certificate passed in the configuration is written in place by cloud-init
+if ! {load_ssl}; then
+    openssl req -new -x509 -nodes -out "{ssl_certs_dir}/{ssl_pem_filename}" -keyout "{ssl_private_dir}/{ssl_key_filename}" -days 3650 -subj "/CN={host_name}"
+fi
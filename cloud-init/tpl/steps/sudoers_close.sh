@@ -0,0 +1,8 @@
+touch /etc/sudoers.tmp
+cp /etc/sudoers /tmp/sudoers.new
+find_replace /tmp/sudoers.new "Defaults    !requiretty" "Defaults    requiretty"
+visudo -c -f /tmp/sudoers.new
+if [ "$?" -eq "0" ]; then
+    cp /tmp/sudoers.new /etc/sudoers
+fi
+rm /etc/sudoers.tmp
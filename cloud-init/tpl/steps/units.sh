@@ -0,0 +1,3 @@
+# Start the services at boot, in the order of their dependencies (units written by cloud-init)
+systemctl daemon-reload
+systemctl enable {units}
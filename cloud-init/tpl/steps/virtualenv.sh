@@ -0,0 +1,5 @@
+# Create Indico base dir
+mkdir -p {indico_inst_dir}
+
+# Create virtualenv
+virtualenv {indico_inst_dir}/env
@@ -0,0 +1,213 @@
+"""
+Offline checks of the generated files.
+
+A broken configuration is otherwise only noticed once an instance boots,
+minutes later. These checks look at the files rendered in memory (plus the
+SSL certificate and key), and collect the problems they find in a `Report`.
+The external tools they use (bash, openssl) are optional: if one is missing,
+its checks are skipped with a warning.
+"""
+
+import base64
+import re
+import subprocess
+import zlib
+
+from yaml import YAMLError, safe_load
+
+import sizing
+
+
+# Directives which may appear several times in redis.conf
+REDIS_MULTI = ('save', 'rename-command', 'client-output-buffer-limit', 'include')
+REDIS_BOOLEANS = ('daemonize', 'appendonly', 'rdbcompression', 'rdbchecksum', 'stop-writes-on-bgsave-error',
+                  'slave-serve-stale-data', 'slave-read-only', 'activerehashing', 'no-appendfsync-on-rewrite',
+                  'repl-disable-tcp-nodelay', 'aof-rewrite-incremental-fsync')
+REDIS_POLICIES = ('volatile-lru', 'allkeys-lru', 'volatile-random', 'allkeys-random', 'volatile-ttl', 'noeviction')
+
+APACHE_SECTION = re.compile(r'^\s*<(/?)(\w+)[^>]*>\s*$')
+
+
+class Report(object):
+    def __init__(self, name):
+        self.name = name
+        self.errors = []
+        self.warnings = []
+
+    def error(self, fname, message):
+        self.errors.append('{0}: {1}'.format(fname, message))
+
+    def warning(self, fname, message):
+        self.warnings.append('{0}: {1}'.format(fname, message))
+
+
+def _run(args, data=None):
+    """
+    (return code, stdout, stderr) of a command, or None if it isn't installed
+    """
+
+    try:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    out, err = proc.communicate(data.encode('utf-8') if data is not None else None)
+    return proc.returncode, out.decode('utf-8', 'replace'), err.decode('utf-8', 'replace')
+
+
+def _decode(entry):
+    content = entry['content']
+    if entry.get('encoding') in ('gz+b64', 'gzip+base64', 'gz+base64', 'gzip+b64'):
+        # 16 + MAX_WBITS: gzip header
+        return zlib.decompress(base64.b64decode(content), 16 + zlib.MAX_WBITS).decode('utf-8')
+    elif entry.get('encoding') in ('b64', 'base64'):
+        return base64.b64decode(content).decode('utf-8')
+    return str(content)
+
+
+def cloud_config(report, content, expected_files):
+    """
+    `expected_files` maps every path that `write_files` should contain to its content and permissions
+    """
+
+    if not content.startswith('#cloud-config\n'):
+        report.error('cloud-config', "doesn't start with '#cloud-config'")
+
+    try:
+        data = safe_load(content)
+    except YAMLError as e:
+        report.error('cloud-config', 'invalid YAML ({0})'.format(' '.join(str(e).split())))
+        return
+
+    if not isinstance(data, dict):
+        report.error('cloud-config', 'not a mapping')
+        return
+
+    written = {}
+    for entry in data.get('write_files') or []:
+        if not isinstance(entry, dict) or 'path' not in entry or 'content' not in entry:
+            report.error('cloud-config', 'invalid write_files entry {0!r}'.format(entry))
+            continue
+        if entry['path'] in written:
+            report.error('cloud-config', "'{0}' is written twice".format(entry['path']))
+        written[entry['path']] = entry
+
+    for path, (expected, permissions) in sorted(expected_files.items()):
+        if path not in written:
+            report.error('cloud-config', "'{0}' is not written".format(path))
+            continue
+        try:
+            decoded = _decode(written[path])
+        except (TypeError, ValueError, zlib.error):
+            report.error('cloud-config', "the content of '{0}' can't be decoded".format(path))
+            continue
+        if decoded.rstrip('\n') != expected.rstrip('\n'):
+            report.error('cloud-config', "the content of '{0}' is altered".format(path))
+        if str(written[path].get('permissions')) != permissions:
+            report.error('cloud-config', "'{0}' has permissions {1} instead of {2}".format(
+                path, written[path].get('permissions'), permissions))
+    for path in sorted(set(written) - set(expected_files)):
+        report.error('cloud-config', "unexpected file '{0}'".format(path))
+
+
+def shell_script(report, fname, content):
+    result = _run(['bash', '-n'], content)
+    if result is None:
+        report.warning(fname, 'bash not found, syntax not checked')
+    elif result[0]:
+        for line in result[2].splitlines():
+            report.error(fname, line.replace('bash: ', '', 1))
+
+
+def apache_conf(report, fname, content):
+    sections = []
+    daemons = set()
+    groups = []
+
+    for number, line in enumerate(content.splitlines(), 1):
+        match = APACHE_SECTION.match(line)
+        if match:
+            closing, tag = match.groups()
+            if not closing:
+                sections.append((tag, number))
+            elif not sections or sections[-1][0].lower() != tag.lower():
+                report.error(fname, 'line {0}: unexpected </{1}>'.format(number, tag))
+            else:
+                sections.pop()
+            continue
+
+        fields = line.split()
+        if fields[:1] == ['WSGIDaemonProcess'] and len(fields) > 1:
+            daemons.add(fields[1])
+        elif fields[:1] == ['WSGIProcessGroup'] and len(fields) > 1:
+            groups.append((fields[1], number))
+        elif fields[:1] == ['WSGIImportScript']:
+            groups += [(f.split('=', 1)[1], number) for f in fields[2:] if f.startswith('process-group=')]
+        elif fields[:2] == ['RewriteRule', '^'] and len(fields) > 3 and fields[3].startswith('[E=INDICO_WSGI_GROUP:'):
+            # routing of the connections to several groups (see `WSGIProcessGroup %{ENV:INDICO_WSGI_GROUP}`)
+            groups.append((fields[3].split(':', 1)[1].rstrip(']'), number))
+
+    for tag, number in sections:
+        report.error(fname, 'line {0}: <{1}> is never closed'.format(number, tag))
+    for group, number in groups:
+        if group not in daemons and not group.startswith('%{ENV:'):
+            report.error(fname, "line {0}: unknown WSGI process group '{1}'".format(number, group))
+
+
+def redis_conf(report, fname, content):
+    """
+    Returns the (last) arguments of every directive, for checks across instances
+    """
+
+    directives = {}
+    for number, line in enumerate(content.splitlines(), 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        directive = fields[0].lower()
+        if len(fields) < 2:
+            report.error(fname, "line {0}: '{1}' has no value".format(number, directive))
+        if directive in directives and directive not in REDIS_MULTI:
+            report.error(fname, "line {0}: '{1}' is set twice".format(number, directive))
+        directives[directive] = fields[1:]
+
+    def _value(directive):
+        return (directives.get(directive) or [None])[0]
+
+    port = _value('port')
+    if not port or not port.isdigit() or not 0 <= int(port) <= 65535:
+        report.error(fname, "invalid port '{0}'".format(port))
+    for directive in REDIS_BOOLEANS:
+        if directive in directives and _value(directive) not in ('yes', 'no'):
+            report.error(fname, "'{0}' must be yes or no".format(directive))
+    # with `sizing: auto`, the values are only known when the instance boots
+    tokens = (sizing.token('redis_maxmemory'), sizing.token('redis_cache_maxmemory'))
+    if (_value('maxmemory') not in tokens and
+            not re.match(r'^\d+([kmg]b?)?$', _value('maxmemory') or '0', re.IGNORECASE)):
+        report.error(fname, "invalid maxmemory '{0}'".format(_value('maxmemory')))
+    if _value('maxmemory-policy') not in REDIS_POLICIES + (None, sizing.token('redis_maxmemory_policy')):
+        report.error(fname, "invalid maxmemory-policy '{0}'".format(_value('maxmemory-policy')))
+    if set(directives.get('bind', [])) - set(['127.0.0.1', 'localhost']) and not _value('requirepass'):
+        report.error(fname, 'reachable from the network without a password')
+
+    return directives
+
+
+def ssl_pair(report, pem_path, key_path):
+    """
+    The certificate must be valid and match the key (same public key)
+    """
+
+    cert = _run(['openssl', 'x509', '-noout', '-pubkey', '-in', pem_path])
+    if cert is None:
+        report.warning(pem_path, 'openssl not found, certificate not checked')
+        return
+    key = _run(['openssl', 'pkey', '-pubout', '-in', key_path])
+
+    if cert[0]:
+        report.error(pem_path, 'not a valid certificate')
+    elif key[0]:
+        report.error(key_path, 'not a valid private key')
+    elif cert[1].strip() != key[1].strip():
+        report.error(pem_path, "doesn't match the key '{0}'".format(key_path))
+    elif _run(['openssl', 'x509', '-noout', '-checkend', '0', '-in', pem_path])[0]:
+        report.error(pem_path, 'the certificate has expired')
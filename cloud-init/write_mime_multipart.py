@@ -0,0 +1,166 @@
+# largely taken from python examples
+# http://docs.python.org/library/email-examples.html
+
+import os
+import sys
+
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from io import BytesIO
+from optparse import OptionParser
+import gzip
+
+from base64 import b64encode
+
+COMMASPACE = ', '
+
+starts_with_mappings = {
+    '#include': 'text/x-include-url',
+    '#!': 'text/x-shellscript',
+    '#cloud-config': 'text/cloud-config',
+    '#upstart-job': 'text/upstart-job',
+    '#part-handler': 'text/part-handler',
+    '#cloud-boothook': 'text/cloud-boothook'
+}
+
+
+def get_content_type(content, deftype):
+    """
+    Detect the MIME type of a part from its first line
+    """
+
+    line = content.split('\n', 1)[0]
+
+    rtype = deftype
+    for key, mtype in starts_with_mappings.items():
+        if line.startswith(key):
+            rtype = mtype
+            break
+
+    return rtype
+
+
+def get_type(fname, deftype):
+    with open(fname, "r") as f:
+        line = f.readline()
+
+    return get_content_type(line, deftype)
+
+
+def build_multipart(parts, deftype="text/plain", boundary=None):
+    """
+    Build the multipart message from in-memory parts.
+
+    `parts` is a sequence of `(filename, content, mtype)` tuples; if `mtype`
+    is `None` it is detected from the content.
+    """
+
+    outer = MIMEMultipart(boundary=boundary)
+
+    for fname, content, mtype in parts:
+        if mtype is None:
+            mtype = get_content_type(content, deftype)
+
+        maintype, subtype = mtype.split('/', 1)
+        if maintype == 'text':
+            # Note: we should handle calculating the charset
+            msg = MIMEText(content, _subtype=subtype)
+        else:
+            msg = MIMEBase(maintype, subtype)
+            msg.set_payload(content)
+
+            # Encode the payload using Base64
+            encoders.encode_base64(msg)
+
+        # Set the filename parameter
+        msg.add_header('Content-Disposition', 'attachment',
+                       filename=os.path.basename(fname))
+
+        outer.attach(msg)
+
+    return outer
+
+
+def _write_encoded(outer, ofile, compress, base64, filename):
+    output = outer.as_string()
+    if not isinstance(output, bytes):
+        output = output.encode('utf-8')
+
+    if base64:
+        output = b64encode(output)
+
+    if compress:
+        # mtime is fixed so that the same input always gives the same output
+        gfile = gzip.GzipFile(fileobj=ofile, mode='wb', filename=filename, mtime=0)
+        gfile.write(output)
+        gfile.close()
+    else:
+        ofile.write(output)
+
+
+def encode_multipart(outer, compress=False, base64=False, filename=''):
+    """
+    Serialize the message, optionally encoding it in base64 and/or compressing it
+    """
+
+    buf = BytesIO()
+    _write_encoded(outer, buf, compress, base64, filename)
+    return buf.getvalue()
+
+
+def write_multipart(parts, ofile, compress=False, base64=False, deftype="text/plain", filename=''):
+    """
+    Write the multipart message built from `parts` to the (binary) file object `ofile`
+    """
+
+    _write_encoded(build_multipart(parts, deftype), ofile, compress, base64, filename)
+
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option("-o", "--output", dest="output",
+                      help="write output to FILE [default %default]", metavar="FILE",
+                      default="-")
+    parser.add_option("-z", "--gzip", dest="compress", action="store_true",
+                      help="compress output", default=False)
+    parser.add_option("-d", "--default", dest="deftype",
+                      help="default mime type [default %default]", default="text/plain")
+    parser.add_option("--delim", dest="delim",
+                      help="delimiter [default %default]", default=":")
+    parser.add_option("-b", "--base64", dest="base64", action="store_true",
+                      help="encode content base64", default=False)
+
+    (options, args) = parser.parse_args()
+
+    if (len(args)) < 1:
+        parser.error("Must give file list see '--help'")
+
+    parts = []
+    for arg in args:
+        t = arg.split(options.delim, 1)
+        path = t[0]
+
+        if len(t) > 1:
+            # explicit type was set
+            mtype = t[1]
+        else:
+            mtype = get_type(path, options.deftype)
+
+        mode = 'r' if mtype.startswith('text/') else 'rb'
+        with open(path, mode) as fp:
+            parts.append((path, fp.read(), mtype))
+
+    if options.output == "-":
+        ofile = getattr(sys.stdout, 'buffer', sys.stdout)
+    else:
+        ofile = open(options.output, "wb")
+
+    write_multipart(parts, ofile, options.compress, options.base64, options.deftype, options.output)
+
+    ofile.close()
+
+if __name__ == '__main__':
+    main()
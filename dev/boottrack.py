@@ -0,0 +1,184 @@
+"""
+Boot progress tracking for the QEMU serial console.
+
+The console is read in a background thread and written (buffered) to the
+log file, while each line is matched against a list of milestones. The
+time at which every milestone is reached is recorded, which gives the
+duration of each provisioning phase. The markers printed by the user-data
+script also carry the time of the guest, which isn't affected by the
+buffering of the console.
+"""
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+# (name, pattern, message) - the 'arg' group is appended to the name, and
+# the 'ts' group is the time of the guest
+GUEST_TIME = r'(?: (?P<ts>\d+\.\d+))?'
+MILESTONES = [
+    ('cloud_init', r'^cloud-init', 'Cloud-init running'),
+    ('config_start', r'.*indico-cloud-init: start config' + GUEST_TIME, 'Indico configuration started'),
+    ('step', r'.*indico-cloud-init: step (?P<arg>\w+)' + GUEST_TIME, 'Step'),
+    ('step_done', r'.*indico-cloud-init: finished step (?P<arg>\w+)' + GUEST_TIME, 'Step finished'),
+    ('yum', r'^Resolving Dependencies', 'yum install started'),
+    ('yum_done', r'^Complete!', 'yum install finished'),
+    ('easy_install', r'^Searching for (?P<arg>\S+)', 'easy_install started'),
+    ('easy_install_done', r'^Finished processing dependencies for (?P<arg>\S+)', 'easy_install finished'),
+    ('config_done', r'.*indico-cloud-init: config done' + GUEST_TIME, 'Indico configuration finished!')
+]
+
+
+class BootTimeout(Exception):
+    pass
+
+
+class BootTracker(object):
+    def __init__(self, socket_path, log_path, milestones=MILESTONES, timeout=3600):
+        self.socket_path = socket_path
+        self.log_path = log_path
+        self.milestones = [(name, re.compile(pattern), msg) for name, pattern, msg in milestones]
+        self.timeout = timeout
+        self.events = []
+        self.guest_events = []
+        self._queue = Queue()
+        self._sock = None
+        self._thread = None
+        self._start_time = None
+
+    def connect(self, timeout=60):
+        """
+        Wait for QEMU to create the socket and connect to it, with backoff
+        """
+
+        deadline = time.time() + timeout
+        delay = 0.05
+
+        while True:
+            if os.path.exists(self.socket_path):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.socket_path)
+                    break
+                except socket.error:
+                    sock.close()
+            if time.time() > deadline:
+                raise BootTimeout("Socket '{0}' not available after {1}s".format(self.socket_path, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+        self._sock = sock
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _match(self, line):
+        for name, regex, msg in self.milestones:
+            m = regex.match(line)
+            if m:
+                groups = m.groupdict()
+                if groups.get('arg'):
+                    name = '{0}:{1}'.format(name, groups['arg'])
+                    msg = '{0}: {1}'.format(msg, groups['arg'])
+                guest_time = float(groups['ts']) if groups.get('ts') else None
+                return name, msg, guest_time
+        return None
+
+    def _read(self):
+        pending = b''
+        with open(self.log_path, 'wb') as log_file:
+            while True:
+                try:
+                    data = self._sock.recv(4096)
+                except socket.error:
+                    break
+                if not data:
+                    break
+                log_file.write(data)
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    match = self._match(line.decode('utf-8', 'replace').strip('\r'))
+                    if match:
+                        event = (match[0], match[1], time.time() - self._start_time)
+                        self.events.append(event)
+                        if match[2] is not None:
+                            self.guest_events.append((match[0], match[2]))
+                        self._queue.put(event)
+        self._queue.put(None)
+
+    def wait_for(self, name, callback=None):
+        """
+        Wait until the milestone `name` is reached, calling `callback` for every milestone
+        """
+
+        while True:
+            remaining = self._start_time + self.timeout - time.time()
+            try:
+                event = self._queue.get(timeout=max(remaining, 0))
+            except Empty:
+                raise BootTimeout("'{0}' not reached after {1}s".format(name, self.timeout))
+            if event is None:
+                raise BootTimeout("Console closed before '{0}' was reached".format(name))
+            if callback:
+                callback(*event)
+            if event[0] == name:
+                return event
+
+    def close(self):
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+        if self._thread:
+            self._thread.join(5)
+
+    @staticmethod
+    def _phases(events):
+        phases = []
+        for i, (name, start) in enumerate(events):
+            end = events[i + 1][1] if i + 1 < len(events) else start
+            phases.append({'name': name, 'start': round(start, 3), 'duration': round(end - start, 3)})
+        return phases
+
+    def _guest_phases(self, guest_start):
+        # Steps may run in parallel, so they last until they are finished rather than until the next one starts
+        finished = dict((name.split(':', 1)[1], ts) for name, ts in self.guest_events if name.startswith('step_done:'))
+        phases = self._phases([(name, ts - guest_start) for name, ts in self.guest_events
+                               if not name.startswith('step_done:')])
+        for phase in phases:
+            step = phase['name'].split(':', 1)[1] if phase['name'].startswith('step:') else None
+            if step in finished:
+                phase['duration'] = round(finished[step] - guest_start - phase['start'], 3)
+        return phases
+
+    def report(self):
+        """
+        Duration of every phase, from one milestone to the next, as seen from the host
+        and (for the markers of the user-data script) from the guest
+        """
+
+        guest_start = self.guest_events[0][1] if self.guest_events else 0
+
+        return {
+            'total': round(self.events[-1][2], 3) if self.events else 0,
+            'phases': self._phases([(name, elapsed) for name, _, elapsed in self.events]),
+            'guest_total': round(self.guest_events[-1][1] - guest_start, 3) if self.guest_events else None,
+            'guest_phases': self._guest_phases(guest_start)
+        }
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
@@ -1,21 +1,33 @@
+import json
 import os
-import re
-import uuid
 import socket
+import sys
+import threading
 import time
+import uuid
 
 from fabric.api import *
-from fabric.contrib.files import sed
-from fabric.operations import put, run
+from fabric.operations import run
 from fabric.context_managers import settings
 from fabric.colors import yellow, green
+from fabric.utils import abort
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-init'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from templates import render
+from boottrack import BootTimeout, BootTracker
+import loadtest
+from remote_batch import remote_batch
 
 
 def _build_parameters():
     env.hosts = [env.host_machine['name'] + ':' +
                  str(env.host_machine['ssh_port'])]
     env.img_path = os.path.join(env.img_dir, env.img_name)
+    env.golden_img_path = os.path.join(env.img_dir, env.golden_img_name)
     env.vd_path = os.path.join(env.img_dir, env.vd_name)
+    env.mirror_disk_path = os.path.join(env.img_dir, env.mirror_disk_name)
 
     env.db_inst_dir = os.path.join(env.indico_inst_dir, env.db_inst_dirname)
     env.indico_conf_dir = os.path.join(env.indico_inst_dir,
@@ -41,39 +53,25 @@ def _debug_update():
     Enable port forwarding in case of debug or disable it otherwise
     """
 
-    # Modifying the ports in indico.conf
-    sed(os.path.join(env.indico_conf_dir, 'indico.conf'),
-        '^(#)? *BaseURL.*',
-        "BaseURL = \"http://{0}:{1}/indico\""
-        .format(env.host_machine['name'], env.host_machine['http_port']))
-    sed(os.path.join(env.indico_conf_dir, 'indico.conf'),
-        '^(#)? *BaseSecureURL.*', "BaseSecureURL = \"https://{0}:{1}/indico\""
-                                  .format(env.host_machine['name'], env.host_machine['https_port']))
-    sed(os.path.join(env.indico_conf_dir, 'indico.conf'),
-        '^(#)? *LoginURL.*', "LoginURL = \"https://{0}:{1}/indico/signIn.py\""
-                             .format(env.host_machine['name'], env.host_machine['https_port']))
-    sed(os.path.join(env.httpd_conf_dir, 'httpd.conf'),
-        '^(#)? *ServerName.*', "ServerName {0}".format(env.host_machine['name']))
-
-
-def _putl(source_file, dest_dir):
-    """
-    To be used instead of put, since it doesn't support symbolic links
-    """
-
-    put(source_file, '/')
-    run("mkdir -p {0}".format(dest_dir))
-    run("mv -f /{0} {1}".format(os.path.basename(source_file), dest_dir))
-
-
-def add_line(file_path, number, line):
-    run("sed -i.bak -r -e \"{0}i\\{1}\" {2}".format(number, line, file_path))
+    with remote_batch() as batch:
+        # Modifying the ports in indico.conf
+        batch.sed(os.path.join(env.indico_conf_dir, 'indico.conf'),
+                  '^(#)? *BaseURL.*',
+                  "BaseURL = \"http://{0}:{1}/indico\""
+                  .format(env.host_machine['name'], env.host_machine['http_port']))
+        batch.sed(os.path.join(env.indico_conf_dir, 'indico.conf'),
+                  '^(#)? *BaseSecureURL.*', "BaseSecureURL = \"https://{0}:{1}/indico\""
+                                            .format(env.host_machine['name'], env.host_machine['https_port']))
+        batch.sed(os.path.join(env.indico_conf_dir, 'indico.conf'),
+                  '^(#)? *LoginURL.*', "LoginURL = \"https://{0}:{1}/indico/signIn.py\""
+                                       .format(env.host_machine['name'], env.host_machine['https_port']))
+        batch.sed(os.path.join(env.httpd_conf_dir, 'httpd.conf'),
+                  '^(#)? *ServerName.*', "ServerName {0}".format(env.host_machine['name']))
 
 
 def _gen_file(rules_dict, in_path, out_path):
-    with open(in_path, 'r') as fin:
-        with open(out_path, 'w+') as fout:
-            fout.write(fin.read().format(**rules_dict))
+    with open(out_path, 'w+') as fout:
+        fout.write(render(in_path, rules_dict))
 
 
 def _gen_random_pswd():
@@ -93,14 +91,6 @@ def _gen_self_signed_cert():
                 env.guest_machine['name']))
 
 
-def _wait_for(fin, pattern, log_file):
-    for line in fin:
-        log_file.write(line)
-        log_file.flush()
-        if re.match(pattern, line):
-            break
-
-
 @task
 def start(**params):
     """
@@ -109,60 +99,422 @@ def start(**params):
 
     _update_params(**params)
 
-    run('service redis start')
-    run("zdaemon -C {0} start".format(os.path.join(env.indico_conf_dir, 'zdctl.conf')))
-    run('service httpd start')
+    # systemd starts them in the order of their dependencies
+    run('systemctl start redis indico-zeo httpd')
 
 
-@task
-def launch_vm(**params):
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _vm(index=None):
     """
-    Run the Virtual Machine
+    Files and ports used by a VM: the configured ones or, for the `index`-th VM
+    of a concurrent launch, its own copies and free host ports
     """
 
-    _update_params(**params)
+    if index is None:
+        return {
+            'name': env.guest_machine['name'],
+            'img_path': env.img_path,
+            'vd_path': env.vd_path,
+            'meta_data': os.path.join(env.conf_dir, 'meta-data'),
+            'socket_path': './log_socket',
+            'qemu_log': env.qemu_log,
+            'boot_report': env.boot_report,
+            'pid_file': 'qemu.pid',
+            'host_machine': env.host_machine
+        }
+
+    name = 'vm{0}'.format(index)
+    return {
+        'name': name,
+        'base_img_path': env.img_path,
+        'img_path': os.path.join(env.img_dir, '{0}.qcow2'.format(name)),
+        'vd_path': os.path.join(env.img_dir, 'init-{0}.iso'.format(name)),
+        'meta_data': os.path.join(env.img_dir, 'meta-data-{0}'.format(name)),
+        'socket_path': './log_socket-{0}'.format(name),
+        'qemu_log': 'qemu-output-{0}.log'.format(name),
+        'boot_report': 'boot-report-{0}.json'.format(name),
+        'pid_file': 'qemu-{0}.pid'.format(name),
+        'host_machine': dict(env.host_machine, ssh_port=_free_port(),
+                             http_port=_free_port(), https_port=_free_port())
+    }
+
+
+def _vm_host(vm):
+    return '{0}:{1}'.format(vm['host_machine']['name'], vm['host_machine']['ssh_port'])
+
+
+def _prepare_vm(vm, user_data):
+    """
+    Create the overlay disk, meta-data and no-cloud ISO of a concurrently launched VM
+    """
 
-    socket_path = './log_socket'
+    local("qemu-img create -f qcow2 -b {0} {1}".format(os.path.abspath(vm['base_img_path']), vm['img_path']))
+    with open(vm['meta_data'], 'w') as f:
+        f.write("instance-id: iid-local-{0}\nlocal-hostname: indico-test-{0}\n".format(vm['name']))
+    _make_no_cloud_iso(user_data, vm['vd_path'], vm['meta_data'])
 
-    local("rm -f {0} {1}".format(socket_path, env.qemu_log))
 
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+def _boot_vm(vm):
+    local("rm -f {0} {1}".format(vm['socket_path'], vm['qemu_log']))
 
     # if in debug mode, redirect to local port (for testing)
     if env.debug_vm:
         redir = " -redir tcp:{0}::{1} -redir tcp:{2}::{3}" \
-                .format(env.host_machine['http_port'], env.guest_machine['http_port'],
-                        env.host_machine['https_port'], env.guest_machine['https_port'])
+                .format(vm['host_machine']['http_port'], env.guest_machine['http_port'],
+                        vm['host_machine']['https_port'], env.guest_machine['https_port'])
     else:
         redir = ""
 
+    # local package mirror (see 'mirror_disk')
+    if env.use_mirror_disk:
+        drives = " -drive file='{0}',if=virtio,readonly=on".format(env.mirror_disk_path)
+    else:
+        drives = ""
+
     local(("{0} -m 1024 -redir tcp:{4}::{5}{6} -net nic -net user, -drive file={1}" +
-          ",if=virtio -drive file='{2}',if=virtio -serial unix:{3},server &")
-          .format(env.virtualization_cmd, env.img_path, env.vd_path, socket_path,
-                  env.host_machine['ssh_port'], env.guest_machine['ssh_port'], redir))
+          ",if=virtio -drive file='{2}',if=virtio{7} -serial unix:{3},server -pidfile {8} &")
+          .format(env.virtualization_cmd, vm['img_path'], vm['vd_path'], vm['socket_path'],
+                  vm['host_machine']['ssh_port'], env.guest_machine['ssh_port'], redir, drives, vm['pid_file']))
+
+
+def _wait_vm_exit(vm, timeout=300):
+    """
+    Wait until the QEMU process of a VM exits, once its guest has shut down
+    """
+
+    local("timeout {0} sh -c 'while kill -0 $(cat {1}) 2>/dev/null; do sleep 1; done'".format(
+        timeout, vm['pid_file']))
+
+
+def _flatten_vm_img(vm):
+    """
+    Turn the copy-on-write disk of a VM into a standalone image, which no longer needs the base image
+    """
+
+    local("qemu-img convert -O qcow2 {0} {0}.flat && mv -f {0}.flat {0}".format(vm['img_path']))
+
+
+def _remove_vm_files(vm):
+    local("rm -f {0} {1} {2} {3}".format(vm['vd_path'], vm['meta_data'], vm['pid_file'], vm['socket_path']))
+
+
+def _stop_vm(vm):
+    """
+    Kill a concurrently launched VM and remove its disk, ISO and meta-data
+    """
+
+    with settings(warn_only=True):
+        local("kill $(cat {0})".format(vm['pid_file']))
+    local("rm -f {0}".format(vm['img_path']))
+    _remove_vm_files(vm)
+
+
+def _track_vms(vms):
+    """
+    Follow the boot of several VMs at the same time, until all of them are configured
+    """
+
+    errors = []
+
+    def _track(vm):
+        prefix = '{0}: '.format(vm['name']) if len(vms) > 1 else ''
+        tracker = BootTracker(vm['socket_path'], vm['qemu_log'], timeout=env.boot_timeout)
+
+        def _progress(name, msg, elapsed):
+            print(green("{0}[{1:7.1f}s] {2}".format(prefix, elapsed, msg)))
+
+        try:
+            tracker.connect()
+            print(green("{0}Connected to system log. See '{1}' for details.".format(prefix, vm['qemu_log'])))
+            tracker.wait_for('config_done', _progress)
+        except BootTimeout as e:
+            errors.append('{0}{1}'.format(prefix, e))
+        finally:
+            tracker.close()
+            tracker.write_report(vm['boot_report'])
 
     print(yellow("Connecting to VM log..."))
 
-    # Wait for QEMU to create the Unix socket
-    time.sleep(2)
+    threads = [threading.Thread(target=_track, args=(vm,)) for vm in vms]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        abort('\n'.join(errors))
+
+    for vm in vms:
+        print(green("{0} running (ssh port {1})! Boot timings written to '{2}'."
+                    .format(vm['name'], vm['host_machine']['ssh_port'], vm['boot_report'])))
+
+
+def _launch_vms(user_data, vms):
+    """
+    Launch several VMs at once (see `_vm`), each one with its own disk, no-cloud ISO, serial socket and
+    ports. `user_data` may be a ';'-separated list of files, which are distributed among the VMs.
+    """
+
+    user_data = user_data.split(';')
+
+    for i, vm in enumerate(vms):
+        _prepare_vm(vm, user_data[i % len(user_data)])
+        _boot_vm(vm)
+
+    _track_vms(vms)
+    return vms
+
+
+def _git_commit():
+    with settings(hide('everything'), warn_only=True):
+        commit = local('git rev-parse HEAD', capture=True)
+        status = local('git status --porcelain', capture=True)
+    if commit.failed:
+        return None, False
+    return commit, bool(status.strip())
+
+
+def _benchmark_summary(reports):
+    """
+    Mean duration of every phase (as measured by the guest, if possible) over several boots
+    """
+
+    totals = [r['guest_total'] or r['total'] for r in reports]
+    phases = {}
+    order = []
+    for report in reports:
+        for phase in report['guest_phases'] or report['phases']:
+            if phase['name'] not in phases:
+                order.append(phase['name'])
+            phases.setdefault(phase['name'], []).append(phase['duration'])
+
+    mean = sum(totals) / len(totals)
+    return {
+        'runs': len(reports),
+        'total': {
+            'mean': round(mean, 3),
+            'min': min(totals),
+            'max': max(totals),
+            'stdev': round((sum((t - mean) ** 2 for t in totals) / len(totals)) ** 0.5, 3)
+        },
+        'phases': [{'name': name, 'mean': round(sum(phases[name]) / len(phases[name]), 3)} for name in order]
+    }
+
+
+@task
+def benchmark(variants, runs=3, output=None, **params):
+    """
+    Boot fresh VMs `runs` times per user-data variant ('name=user-data;...') and store the phase timings as JSON
+    """
+
+    _update_params(**params)
+    runs = int(runs)
+
+    commit, dirty = _git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'variants': {}
+    }
+
+    index = 0
+    for variant in variants.split(';'):
+        name, _, user_data = variant.rpartition('=')
+        name = name or os.path.basename(user_data)
+        reports = []
+
+        for i in range(runs):
+            print(yellow("Benchmark '{0}': run {1}/{2}".format(name, i + 1, runs)))
+            # Every run boots the pristine base image (through its own overlay)
+            vm = _vm(index)
+            index += 1
+            _prepare_vm(vm, user_data)
+            _boot_vm(vm)
+            try:
+                _track_vms([vm])
+            finally:
+                _stop_vm(vm)
+            with open(vm['boot_report']) as f:
+                reports.append(json.load(f))
+            os.remove(vm['boot_report'])
+
+        results['variants'][name] = {
+            'user_data': user_data,
+            'summary': _benchmark_summary(reports),
+            'reports': reports
+        }
+
+    if not output:
+        if not os.path.exists(env.benchmark_dir):
+            os.makedirs(env.benchmark_dir)
+        output = os.path.join(env.benchmark_dir, '{0}-{1}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S'), (commit or 'unknown')[:8]))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name, variant in sorted(results['variants'].items()):
+        total = variant['summary']['total']
+        print(green("{0}: {1:.1f}s on average (min {2:.1f}s, max {3:.1f}s)".format(
+            name, total['mean'], total['min'], total['max'])))
+    print(green("Results written to '{0}'.".format(output)))
+
+
+@task
+def compare_benchmarks(*paths):
+    """
+    Compare the mean phase durations of benchmark results (the first variant is the baseline)
+    """
+
+    columns = []
+    for path in paths:
+        with open(path) as f:
+            result = json.load(f)
+        for name, variant in sorted(result['variants'].items()):
+            label = '{0}{1}:{2}'.format((result['commit'] or 'unknown')[:8], '+' if result['dirty'] else '', name)
+            means = dict((phase['name'], phase['mean']) for phase in variant['summary']['phases'])
+            means['total'] = variant['summary']['total']['mean']
+            columns.append((label, means, [phase['name'] for phase in variant['summary']['phases']]))
+
+    if not columns:
+        abort("Please specify the benchmark results to compare")
+
+    rows = ['total']
+    for _, _, order in columns:
+        rows += [name for name in order if name not in rows]
+
+    print('{0:<32}'.format('phase') + ''.join('{0:>26}'.format(label[:25]) for label, _, _ in columns))
+    for row in rows:
+        base = columns[0][1].get(row)
+        cells = []
+        for i, (_, means, _) in enumerate(columns):
+            value = means.get(row)
+            if value is None:
+                cells.append('{0:>26}'.format('-'))
+            elif i and base:
+                cells.append('{0:>26}'.format('{0:.1f}s ({1:+.0%})'.format(value, (value - base) / base)))
+            else:
+                cells.append('{0:>26}'.format('{0:.1f}s'.format(value)))
+        print('{0:<32}'.format(row[:31]) + ''.join(cells))
+
+
+def _print_load_stats(label, stats):
+    if not stats['requests']:
+        print(yellow("{0}: no successful requests ({1} errors)".format(label, stats['errors'])))
+        return
+    print(green("{0}: p50 {1:.0f}ms, p95 {2:.0f}ms, p99 {3:.0f}ms, {4:.1f} req/s, {5} errors".format(
+        label, stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000, stats['throughput'], stats['errors'])))
+
+
+@task
+def load_test(paths=None, duration=60, concurrency=10, schemes='http;https', output=None, **params):
+    """
+    Load a running VM (see run_vm_debug) with concurrent requests, report latencies, throughput, CPU and memory
+    """
+
+    _update_params(**params)
+    duration = int(duration)
+    paths = paths.split(';') if paths else env.load_test_paths
+    ports = {'http': env.host_machine['http_port'], 'https': env.host_machine['https_port']}
+    urls = ['{0}://{1}:{2}{3}'.format(scheme, env.host_machine['name'], ports[scheme], path)
+            for scheme in schemes.split(';') for path in paths]
+
+    print(yellow("Loading {0} URLs with {1} clients for {2}s...".format(len(urls), concurrency, duration)))
+    generator = loadtest.LoadGenerator(urls, int(concurrency), duration)
+    generator.start()
+    # The guest is sampled meanwhile, within a single SSH command
+    with settings(hide('everything'), warn_only=True):
+        samples = run(loadtest.sampler_command(duration))
+    generator.join()
+
+    commit, dirty = _git_commit()
+    report = generator.report()
+    report.update({
+        'commit': commit,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'guest': loadtest.parse_samples(samples)
+    })
+
+    if not output:
+        if not os.path.exists(env.benchmark_dir):
+            os.makedirs(env.benchmark_dir)
+        output = os.path.join(env.benchmark_dir, 'load-{0}-{1}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S'), (commit or 'unknown')[:8]))
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for url in urls:
+        _print_load_stats(url, report['targets'][url])
+    _print_load_stats('overall', report['overall'])
+    cpu = report['guest']['cpu_percent']
+    if cpu:
+        print(green("guest CPU: {0}% on average, {1}% at most".format(cpu['mean'], cpu['max'])))
+    for name, rss in sorted(report['guest']['rss_mb'].items()):
+        if rss:
+            print(green("guest {0} memory: {1} MB on average, {2} MB at most".format(name, rss['mean'], rss['max'])))
+    print(green("Report written to '{0}'.".format(output)))
 
-    sock.connect(socket_path)
 
-    print(green("Connected to system log. See '{0}' for details.".format(env.qemu_log)))
+@task
+def compare_load_tests(*paths):
+    """
+    Compare the overall latencies and throughput of load test reports (the first one is the baseline)
+    """
 
-    sock_f = sock.makefile()
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+
+    if not reports:
+        abort("Please specify the load test reports to compare")
+
+    base = reports[0]
+    for path, report in zip(paths, reports):
+        overall = report['overall']
+        line = "{0} ({1}): ".format(path, (report['commit'] or 'unknown')[:8])
+        cells = []
+        for key in ('p50', 'p95', 'p99', 'throughput'):
+            value, base_value = overall[key], base['overall'][key]
+            if value is None:
+                cells.append('{0} -'.format(key))
+                continue
+            cell = '{0} {1:.0f}ms'.format(key, value * 1000) if key != 'throughput' else '{0:.1f} req/s'.format(value)
+            if report is not base and base_value:
+                cell += ' ({0:+.0%})'.format((value - base_value) / base_value)
+            cells.append(cell)
+        cpu = report['guest']['cpu_percent']
+        if cpu:
+            cells.append('CPU {0}%'.format(cpu['mean']))
+        print(line + ', '.join(cells))
 
-    with open(env.qemu_log, 'w') as log_file:
-        _wait_for(sock_f, r'^cloud-init', log_file)
-        print(green('Cloud-init running'))
 
-        _wait_for(sock_f, r'.*indico-cloud-init: start config', log_file)
-        print(green('Indico configuration started'))
+@task
+def launch_vm(**params):
+    """
+    Run the Virtual Machine
+    """
 
-        _wait_for(sock_f, r'.*indico-cloud-init: config done', log_file)
-        print(green('Indico configuration finished!'))
+    _update_params(**params)
+
+    vm = _vm()
+    _boot_vm(vm)
+    _track_vms([vm])
 
-    print(green("VM running!"))
+
+def _make_no_cloud_iso(user_data, vd_path, meta_data):
+    local("mkisofs -output {0} -volid cidata -joliet -rock {1} {2}"
+          .format(vd_path, user_data, meta_data))
 
 
 @task
@@ -173,35 +525,115 @@ def config_no_cloud(user_data, **params):
 
     _update_params(**params)
 
-    local("mkisofs -output {0} -volid cidata -joliet -rock {1} {2}"
-          .format(env.vd_path, user_data,
-                  os.path.join(env.conf_dir, 'meta-data')))
+    _make_no_cloud_iso(user_data, env.vd_path, os.path.join(env.conf_dir, 'meta-data'))
 
 
-def cleanup_vm():
+@task
+def mirror_disk(cache_dir, **params):
+    """
+    Pack a local mirror (see gen-user-data.py '--prefetch') into a data disk
+    """
+
+    _update_params(**params)
+
+    local("mkisofs -output {0} -volid {1} -joliet -rock {2}"
+          .format(env.mirror_disk_path, env.mirror_disk_label, cache_dir))
+
+
+@task
+def serve_mirror(cache_dir, port=8080):
+    """
+    Serve a local mirror over HTTP (reachable from the VM as http://10.0.2.2:<port>)
+    """
+
+    with lcd(cache_dir):
+        local("python -m SimpleHTTPServer {0}".format(port))
+
+
+def cleanup_vm(reset_cloud_init=False):
     with settings(warn_only=True):
         sudo('rm -f /etc/sysconfig/network-scripts/ifcfg-ens3')
+        if reset_cloud_init:
+            # So that cloud-init runs the user-data again on the next boot
+            sudo('rm -rf /var/lib/cloud/instance /var/lib/cloud/instances /var/lib/cloud/sem')
     sudo('shutdown -h now')
 
 
 @task
-def run_vm_debug(**params):
+def run_vm_debug(user_data=None, count=1, **params):
     """
-    Run the VM and start Indico (debugging purposes)
+    Run the VM and start Indico (debugging purposes); with count=N, launch N VMs from user_data
     """
 
     env.debug_vm = True
-    launch_vm(**params)
-    _debug_update()
-    start()
+    count = int(count)
+
+    if count == 1:
+        launch_vm(**params)
+        _debug_update()
+        start()
+        return
+
+    _update_params(**params)
+    for vm in _launch_vms(user_data, [_vm(i) for i in range(count)]):
+        with settings(host_string=_vm_host(vm), host_machine=vm['host_machine']):
+            _debug_update()
+            start()
+        print(green("{0}: http port {1}, https port {2}".format(
+            vm['name'], vm['host_machine']['http_port'], vm['host_machine']['https_port'])))
 
 
 @task
-def create_vm_img(user_data, **params):
+def create_vm_img(user_data, count=1, **params):
     """
-    Creates a Virtual Image ready to be deployed on the cloud
+    Creates a Virtual Image ready to be deployed on the cloud; with count=N, build N images at once
     """
 
-    config_no_cloud(user_data, **params)
-    launch_vm(**params)
-    cleanup_vm()
+    count = int(count)
+
+    if count == 1:
+        config_no_cloud(user_data, **params)
+        launch_vm(**params)
+        cleanup_vm()
+        return
+
+    _update_params(**params)
+    vms = [_vm(i) for i in range(count)]
+    try:
+        _launch_vms(user_data, vms)
+        execute(parallel(cleanup_vm), hosts=[_vm_host(vm) for vm in vms])
+        for vm in vms:
+            _wait_vm_exit(vm)
+            _flatten_vm_img(vm)
+    finally:
+        for vm in vms:
+            _remove_vm_files(vm)
+
+
+@task
+def bake_vm_img(user_data, **params):
+    """
+    Creates a golden image with everything installed (user-data generated with '--stage bake')
+    """
+
+    _update_params(**params)
+
+    local("cp {0} {1}".format(env.img_path, env.golden_img_path))
+    config_no_cloud(user_data)
+    launch_vm(img_name=env.golden_img_name)
+    cleanup_vm(reset_cloud_init=True)
+
+
+@task
+def personalize_vm(user_data, instance_img_name='indico-instance.qcow2', **params):
+    """
+    Boots an instance of the golden image (user-data generated with '--stage personalize')
+    """
+
+    _update_params(**params)
+
+    # The instance gets a copy-on-write overlay, the golden image is left untouched
+    local("qemu-img create -f qcow2 -b {0} {1}".format(os.path.abspath(env.golden_img_path),
+                                                      os.path.join(env.img_dir, instance_img_name)))
+    config_no_cloud(user_data)
+    launch_vm(img_name=instance_img_name)
@@ -0,0 +1,156 @@
+"""
+Load generator for a running instance.
+
+A number of threads request the given URLs in a loop for a fixed duration,
+recording the latency of every request. Meanwhile, the CPU usage and the
+memory of the main processes of the guest are sampled by a shell loop
+running over SSH (see `sampler_command`).
+"""
+
+import math
+import ssl
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+
+
+# Processes whose memory is sampled on the guest
+PROCESSES = ('httpd', 'redis-server', 'python')
+
+
+def percentile(values, p):
+    """
+    `p`-th percentile (nearest rank) of sorted `values`
+    """
+
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return round(values[rank], 4)
+
+
+class LoadGenerator(object):
+    def __init__(self, urls, concurrency=10, duration=60, timeout=30):
+        self.urls = urls
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.results = dict((url, {'latencies': [], 'errors': 0}) for url in urls)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._elapsed = None
+        self._start_time = None
+        # Test instances use self-signed certificates
+        self._context = ssl._create_unverified_context() if hasattr(ssl, '_create_unverified_context') else None
+
+    def _fetch(self, url):
+        kwargs = {'timeout': self.timeout}
+        if self._context and url.startswith('https'):
+            kwargs['context'] = self._context
+        response = urlopen(url, **kwargs)
+        try:
+            response.read()
+        finally:
+            response.close()
+
+    def _worker(self, offset):
+        deadline = self._start_time + self.duration
+        i = offset
+        while time.time() < deadline:
+            url = self.urls[i % len(self.urls)]
+            i += 1
+            start = time.time()
+            try:
+                self._fetch(url)
+                error = False
+            except (HTTPError, URLError, IOError):
+                error = True
+            latency = time.time() - start
+            with self._lock:
+                if error:
+                    self.results[url]['errors'] += 1
+                else:
+                    self.results[url]['latencies'].append(latency)
+
+    def start(self):
+        self._start_time = time.time()
+        self._threads = [threading.Thread(target=self._worker, args=(i,)) for i in range(self.concurrency)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._elapsed = time.time() - self._start_time
+
+    @staticmethod
+    def _stats(latencies, errors, elapsed):
+        latencies = sorted(latencies)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': round(len(latencies) / elapsed, 2),
+            'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)
+        }
+
+    def report(self):
+        targets = dict((url, self._stats(r['latencies'], r['errors'], self._elapsed))
+                       for url, r in self.results.items())
+        overall = self._stats([l for r in self.results.values() for l in r['latencies']],
+                              sum(r['errors'] for r in self.results.values()), self._elapsed)
+        return {
+            'concurrency': self.concurrency,
+            'duration': round(self._elapsed, 3),
+            'overall': overall,
+            'targets': targets
+        }
+
+
+def sampler_command(duration, interval=1):
+    """
+    Shell loop printing the CPU counters and the memory (RSS, in KB) of the main processes
+    """
+
+    rss = ' '.join('{0}=$(ps -C {0} -o rss= | awk \'{{s+=$1}} END {{print s+0}}\')'.format(p) for p in PROCESSES)
+    return ('for i in $(seq {0}); do echo "sample $(date +%s.%N) $(head -1 /proc/stat | cut -d" " -f2-) rss {1}"; '
+            'sleep {2}; done').format(max(1, int(duration // interval)), rss, interval)
+
+
+def parse_samples(output):
+    """
+    CPU usage (%) and memory (MB) of the guest, from the output of `sampler_command`
+    """
+
+    samples = []
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields or fields[0] != 'sample' or 'rss' not in fields:
+            continue
+        sep = fields.index('rss')
+        cpu = [int(v) for v in fields[2:sep]]
+        rss = dict((k, int(v)) for k, v in (f.split('=', 1) for f in fields[sep + 1:]))
+        # idle + iowait
+        samples.append((sum(cpu), cpu[3] + (cpu[4] if len(cpu) > 4 else 0), rss))
+
+    cpu_usage = []
+    for (total0, idle0, _), (total1, idle1, _) in zip(samples, samples[1:]):
+        if total1 > total0:
+            cpu_usage.append(100.0 * (1 - float(idle1 - idle0) / (total1 - total0)))
+
+    def _summary(values):
+        return {'mean': round(sum(values) / len(values), 1), 'max': round(max(values), 1)} if values else None
+
+    return {
+        'samples': len(samples),
+        'cpu_percent': _summary(cpu_usage),
+        'rss_mb': dict((p, _summary([s[2].get(p, 0) / 1024.0 for s in samples])) for p in PROCESSES)
+    }
@@ -1,22 +1,33 @@
+import json
 import os
 import sys
+import time
 from contextlib import contextmanager
+from pipes import quote
 
-from fabric.api import env, prefix, task, settings
-from fabric.contrib.files import sed
-from fabric.operations import put, run, sudo
-from fabric.colors import red
+from fabric.api import env, execute, hide, parallel, prefix, runs_once, task, settings
+from fabric.operations import run
+from fabric.colors import green, red
+from fabric.utils import abort
+
+from remote_batch import remote_batch
 
 
 @contextmanager
 def virtualenv():
-    with prefix('source {0}/bin/activate'.format(os.path.join(env.indico_dir, env.virtualenv_dirname))):
+    with prefix('source {0}/bin/activate'.format(os.path.join(env.indico_inst_dir, env.virtualenv_dirname))):
         yield
 
 
+def _host_string(machine):
+    return machine['name'] + ':' + str(machine['ssh_port'])
+
+
 def _build_parameters():
-    env.hosts = [env.machine['name'] + ':' + str(env.machine['ssh_port'])]
-    env.indico_conf_dir = os.path.join(env.indico_dir, env.conf_dirname)
+    machines = env.get('machines') or [env.machine]
+    env.hosts = [_host_string(m) for m in machines]
+    env.host_roles = dict((_host_string(m), m.get('role', 'all')) for m in machines)
+    env.indico_conf_dir = os.path.join(env.indico_inst_dir, env.indico_conf_dirname)
 
 
 def _update_params(**params):
@@ -32,14 +43,29 @@ execfile(env.conf, {}, env)
 _build_parameters()
 
 
-def _putl(source_file, dest_dir):
-    """
-    To be used instead of put, since it doesn't support symbolic links
-    """
+def _load_ssl(batch):
+    # Copy the new certificate (uploads follow symbolic links)
+    batch.upload(env.ssl_pem_path, env.ssl_certs_dir)
+    batch.upload(env.ssl_key_path, env.ssl_private_dir, mode='600')
+
+    # Modify the indico.conf SSL entries
+    batch.sed(os.path.join(env.httpd_confd_dir, 'indico.conf'),
+              "{0}.*.pem".format(env.ssl_certs_dir),
+              os.path.join(env.ssl_certs_dir, os.path.basename(env.ssl_pem_path)))
+    batch.sed(os.path.join(env.httpd_confd_dir, 'indico.conf'),
+              "{0}.*.key".format(env.ssl_private_dir),
+              os.path.join(env.ssl_private_dir, os.path.basename(env.ssl_key_path)))
+
+
+def _update_server(batch):
+    indico_conf = os.path.join(env.indico_conf_dir, 'indico.conf')
+
+    batch.sed(os.path.join(env.httpd_conf_dir, 'httpd.conf'),
+              '^ServerName.*', "ServerName {0}".format(env.machine['name']))
 
-    put(source_file, '/')
-    run("mkdir -p {0}".format(dest_dir))
-    run("mv -f /{0} {1}".format(os.path.basename(source_file), dest_dir))
+    batch.sed(indico_conf, '^BaseURL.*', 'BaseURL = "http://{0}"'.format(env.machine['name']))
+    batch.sed(indico_conf, '^BaseSecureURL.*', 'BaseSecureURL = "https://{0}"'.format(env.machine['name']))
+    batch.sed(indico_conf, '^LoginURL.*', 'LoginURL = "https://{0}/user/login"'.format(env.machine['name']))
 
 
 @task
@@ -50,17 +76,8 @@ def load_ssl(**params):
 
     _update_params(**params)
 
-    # Copy the new certificate
-    _putl(env.ssl_pem_path, env.ssl_certs_dir)
-    _putl(env.ssl_key_path, env.ssl_private_dir)
-
-    # Modify the indico.conf SSL entries
-    sed(os.path.join(env.httpd_confd_dir, 'indico.conf'),
-        "{0}.*.pem".format(env.ssl_certs_dir),
-        os.path.join(env.ssl_certs_dir, os.path.basename(env.ssl_pem_path)))
-    sed(os.path.join(env.httpd_confd_dir, 'indico.conf'),
-        "{0}.*.key".format(env.ssl_private_dir),
-        os.path.join(env.ssl_private_dir, os.path.basename(env.ssl_key_path)))
+    with remote_batch() as batch:
+        _load_ssl(batch)
 
 
 @task
@@ -71,75 +88,298 @@ def update_server(**params):
 
     _update_params(**params)
 
-    indico_conf = os.path.join(env.indico_conf_dir, 'indico.conf')
-
-    sed(os.path.join(env.httpd_conf_dir, 'httpd.conf'),
-        '^ServerName.*', "ServerName {0}".format(env.machine['name']))
-
-    sed(indico_conf, '^BaseURL.*', 'BaseURL = "http://{0}"'.format(env.machine['name']))
-    sed(indico_conf, '^BaseSecureURL.*', 'BaseSecureURL = "https://{0}"'.format(env.machine['name']))
-    sed(indico_conf, '^LoginURL.*', 'LoginURL = "https://{0}/user/login"'.format(env.machine['name']))
+    with remote_batch() as batch:
+        _update_server(batch)
 
 
 @task
 def config(**params):
     """
-    Configure the VM with all the necessary information
+    Configure the VM with all the necessary information (in a single remote transaction)
     """
 
-    load_ssl(**params)
-    update_server(**params)
+    _update_params(**params)
+
+    with remote_batch() as batch:
+        _load_ssl(batch)
+        _update_server(batch)
+
+
+# Commands that succeed once a service is ready to accept requests
+_readiness_probes = {
+    'redis': lambda: "redis-cli -p {0}{1} ping | grep -q PONG".format(
+        env.redis_port, " -a '{0}'".format(env.redis_pswd) if env.redis_pswd else ''),
+    'db': lambda: ("test -S {0}".format(env.db_socket) if env.get('db_socket') else
+                   "bash -c 'echo > /dev/tcp/127.0.0.1/{0}'".format(env.db_port)),
+    'httpd': lambda: "curl -s -o /dev/null -w '%{{http_code}}' {0} | grep -q 200".format(env.httpd_probe_url),
+    'scheduler': lambda: "systemctl is-active -q indico-scheduler"
+}
+
 
+# Components run by each role (see cloud-init/roles.py)
+_role_components = {
+    'all': ('redis', 'db', 'httpd', 'scheduler'),
+    'web': ('httpd',),
+    'db': ('db',),
+    'redis': ('redis',),
+    'scheduler': ('scheduler',)
+}
 
-def _service_action(services, action):
-    if services[0] == 'all':
-        services = ["redis", "db", "httpd", "scheduler"]
-    elif not services:
+
+def _services(services):
+    if not services:
         print red("Please specify a service name (or 'all')")
         sys.exit(1)
+    elif services[0] == 'all':
+        return ["redis", "db", "httpd", "scheduler"]
+    return services
+
+
+def _wait_ready(svc):
+    """
+    Poll the readiness probe of a service (with backoff) until it succeeds
+    """
+
+    probe = _readiness_probes[svc]()
+    deadline = time.time() + env.probe_timeout
+    delay = 0.5
+
+    while True:
+        with settings(hide('everything'), warn_only=True):
+            if run(probe).succeeded:
+                print green("{0} ready on {1}".format(svc, env.host_string))
+                return
+        if time.time() > deadline:
+            abort("{0} is not ready on {1} after {2}s".format(svc, env.host_string, env.probe_timeout))
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+# systemd units of each component (see cloud-init/tpl)
+_units = {
+    'redis': lambda: ['redis', 'redis-cache'] if env.get('redis_split') else ['redis'],
+    'db': lambda: ['indico-zeo'],
+    'httpd': lambda: ['httpd'],
+    'scheduler': lambda: ['indico-scheduler']
+}
+
 
+def _warmup(paths=None, requests=None, concurrency=None):
+    """
+    Fetch the hot URLs concurrently on the current host, so that its WSGI processes, Redis and XML
+    caches are filled before it takes traffic
+    """
+
+    paths = paths.split(';') if paths else env.get('warmup_paths', ['/'])
+    requests = int(requests or env.get('warmup_requests', 4))
+    concurrency = int(concurrency or env.get('warmup_concurrency', 8))
+    urls = [env.get('warmup_base_url', 'http://localhost').rstrip('/') + path for path in paths]
+
+    # A single remote command: every URL is fetched `requests` times, `concurrency` at a time
+    with settings(hide('everything'), warn_only=True):
+        output = run("printf '%s\\n' {0} | xargs -n 1 -P {1} curl -sk -o /dev/null -m {2} "
+                     "-w '%{{http_code}} %{{time_total}} %{{url_effective}}\\n'".format(
+                         ' '.join(quote(url) for url in urls for _ in range(requests)), concurrency,
+                         env.probe_timeout), pty=False)
+
+    results = {}
+    for fields in (line.split() for line in output.splitlines()):
+        if len(fields) != 3:
+            continue
+        code, seconds, url = fields
+        result = results.setdefault(url, {'times': [], 'errors': 0})
+        result['times'].append(float(seconds))
+        if code[0] not in '23':
+            result['errors'] += 1
+
+    for url, result in sorted(results.items()):
+        times = result['times']
+        color = red if result['errors'] else green
+        print color("{0}: warmed up {1}, {2} requests ({3} failed), mean {4:.2f}s, max {5:.2f}s".format(
+            env.host_string, url, len(times), result['errors'], sum(times) / len(times), max(times)))
+
+
+def _service_action(services, action, wait=False, warmup=False):
     for svc in services:
-        if svc == 'redis':
-            run('service redis {0}'.format(action))
-        elif svc == 'db':
-            with virtualenv():
-                run("zdaemon -C {0} {1}".format(os.path.join(env.indico_conf_dir, 'zdctl.conf'), action))
-        elif svc == 'scheduler':
-            with virtualenv():
-                if action in ['start', 'restart']:
-                    with settings(shell='/bin/bash -c'):
-                            sudo("nohup indico_scheduler {0} > /dev/null".format(action), user="apache")
-                else:
-                    sudo("indico_scheduler {0}".format(action))
-
-        elif svc == 'httpd':
-            run('service httpd {0}'.format(action))
-        else:
+        if svc not in _units:
             print red("Unknown service: {0}".format(svc))
             sys.exit(1)
 
+    # In a split deployment, each host only runs the components of its role
+    components = _role_components[env.host_roles.get(env.host_string, 'all')]
+    services = [svc for svc in services if svc in components]
+
+    # A single call: systemd acts on the units in parallel, in the order of their dependencies
+    units = [unit for svc in services for unit in _units[svc]()]
+    if units:
+        run('systemctl {0} {1}'.format(action, ' '.join(units)))
+
+    if wait and action in ['start', 'restart']:
+        for svc in services:
+            _wait_ready(svc)
+        if warmup and 'httpd' in services:
+            _warmup()
+
+
+def _target_hosts(machines):
+    """
+    Hosts to act on: either the ones passed as 'host[:port];host[:port]' or all configured machines
+    """
+
+    if machines:
+        return [h if ':' in h else h + ':22' for h in machines.split(';')]
+    return env.hosts
+
+
+def _run_on_hosts(what, action, machines=None, workers=None, rolling=False, batch=None, wait=True, warmup=False):
+    services = _services(what)
+    hosts = _target_hosts(machines)
+    workers = int(workers or env.parallel_workers)
+    warmup = str(warmup).lower() in ('1', 'true', 'yes', 'y')
+    # the web servers are only warmed up once they are ready
+    wait = str(wait).lower() in ('1', 'true', 'yes', 'y') or warmup
+
+    func = parallel(pool_size=workers)(_service_action)
+
+    if str(rolling).lower() in ('1', 'true', 'yes', 'y'):
+        # Act on a batch of hosts at a time, the next one only starts once all services are ready
+        batch = int(batch or env.rolling_batch)
+        for i in range(0, len(hosts), batch):
+            group = hosts[i:i + batch]
+            print green("Rolling {0}: {1}".format(action, ', '.join(group)))
+            execute(func, services, action, wait=True, warmup=warmup, hosts=group)
+    else:
+        execute(func, services, action, wait=wait, warmup=warmup, hosts=hosts)
+
 
 @task
-def start(*what):
+@runs_once
+def start(*what, **params):
     """
-    Start Indico components
+    Start Indico components (machines='host1;host2', workers=N, wait=no, warmup=yes)
     """
-    _service_action(what, 'start')
+    _run_on_hosts(what, 'start', **params)
 
 
 @task
-def restart(*what):
+@runs_once
+def restart(*what, **params):
     """
-    Restart Indico components
+    Restart Indico components (machines='host1;host2', workers=N, rolling=yes, batch=N, warmup=yes)
     """
 
-    _service_action(what, 'restart')
+    _run_on_hosts(what, 'restart', **params)
 
 
 @task
-def stop(*what):
+def warmup(paths=None, requests=None, concurrency=None, **params):
+    """
+    Fetch the hot URLs concurrently on the web servers, to fill their caches (paths='/a;/b', requests=N, concurrency=N)
     """
-    Stop Indico components
+
+    _update_params(**params)
+
+    if 'httpd' not in _role_components[env.host_roles.get(env.host_string, 'all')]:
+        return
+
+    _warmup(paths, requests, concurrency)
+
+
+@task
+@runs_once
+def stop(*what, **params):
+    """
+    Stop Indico components (machines='host1;host2', workers=N)
+    """
+
+    params['wait'] = False
+    _run_on_hosts(what, 'stop', **params)
+
+
+def _human_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+
+
+@task
+def pack_db(days=0, **params):
     """
+    Pack the database online, keeping `days` of history, and report its size before/after
+    """
+
+    _update_params(**params)
+
+    if 'db' not in _role_components[env.host_roles.get(env.host_string, 'all')]:
+        return
+
+    data_fs = os.path.join(env.db_inst_dir, 'Data.fs')
+    if env.get('db_socket'):
+        address = '-U {0}'.format(env.db_socket)
+    else:
+        address = '-h localhost -p {0}'.format(env.db_port)
+
+    # A single remote command, which prints the sizes and the time taken
+    with virtualenv(), settings(hide('output')):
+        output = run("echo before $(stat -c %s {0}) $(date +%s.%N) && zeopack -d {1} {2} && "
+                     "echo after $(stat -c %s {0}) $(date +%s.%N)".format(data_fs, days, address))
+
+    values = dict((fields[0], fields[1:]) for fields in (line.split() for line in output.splitlines())
+                  if fields and fields[0] in ('before', 'after'))
+    before, after = int(values['before'][0]), int(values['after'][0])
+    duration = float(values['after'][1]) - float(values['before'][1])
+    print green("{0}: packed {1} from {2} to {3} ({4:+.0%}) in {5:.1f}s".format(
+        env.host_string, data_fs, _human_size(before), _human_size(after),
+        float(after - before) / before if before else 0, duration))
+
+
+def _stats_settings(samples, interval):
+    """
+    What `stats_collector.py` should look at on the current host, depending on its role
+    """
+
+    components = _role_components[env.host_roles.get(env.host_string, 'all')]
+    stats_settings = {'samples': int(samples), 'interval': float(interval)}
+
+    if 'httpd' in components:
+        stats_settings['apache_status_url'] = env.get('status_url', 'http://localhost/server-status')
+    if 'redis' in components:
+        stats_settings['redis'] = [{'name': 'redis', 'port': env.redis_port, 'password': env.redis_pswd}]
+        if env.get('redis_split'):
+            stats_settings['redis'].append({'name': 'redis-cache', 'port': env.get('redis_cache_port', 6380),
+                                            'password': env.redis_pswd})
+    if 'db' in components:
+        stats_settings['zeo_monitor_port'] = env.get('db_monitor_port', 9676)
+    if 'httpd' in components or 'scheduler' in components:
+        stats_settings['dirs'] = {'archive': os.path.join(env.indico_inst_dir, 'archive'),
+                                  'xml_cache': os.path.join(env.indico_inst_dir, 'cache')}
+    return stats_settings
+
+
+@task
+def stats(samples=1, interval=5, output=None, **params):
+    """
+    Collect httpd, mod_wsgi, Redis, ZEO and disk metrics as JSON (samples=N, interval=s, output='stats-{host}.json')
+    """
+
+    _update_params(**params)
 
-    _service_action(what, 'stop')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats_collector.py')) as f:
+        collector = f.read()
+
+    # The collector is fed to the remote Python, so that everything is sampled in a single command
+    # (without a pty, which would mix the errors with the JSON output)
+    with settings(hide('output')):
+        result = run("python - {0} <<'EOF'\n{1}\nEOF".format(
+            quote(json.dumps(_stats_settings(samples, interval))), collector), pty=False)
+
+    report = json.dumps({'host': env.host_string, 'role': env.host_roles.get(env.host_string, 'all'),
+                         'stats': json.loads(result)}, indent=2, sort_keys=True)
+    if output:
+        path = output.format(host=env.host)
+        with open(path, 'w') as f:
+            f.write(report + '\n')
+        print green("{0}: metrics written to {1}".format(env.host_string, path))
+    else:
+        print report
@@ -0,0 +1,142 @@
+"""
+Batched remote edits for the fabfiles.
+
+Every `sed`, `put` or `run` is a separate round trip to the server, which
+adds up quickly over high-latency links. A `RemoteBatch` instead collects the
+uploads and edits meant for the current host, ships them in a single tarball
+and applies them with a single remote script (over the connection Fabric
+keeps open for the host). The files touched are backed up first, and restored
+if any of the operations fails, so that the server is never left half
+configured.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from fabric.api import put, run, sudo
+
+
+SCRIPT_HEADER = """#!/bin/bash
+cd "$(dirname "$0")"
+mkdir -p backup
+
+function backup(){
+    if [ -e "$1" ]; then
+        cp -a "$1" "backup/$2"
+    fi
+}
+
+function restore(){
+    if [ -e "backup/$2" ]; then
+        cp -a "backup/$2" "$1"
+    else
+        rm -f "$1"
+    fi
+}
+
+function rollback(){
+    echo "remote batch: '$BASH_COMMAND' failed, rolling back" >&2
+"""
+
+
+def _sed_escape_regex(text):
+    # Only the delimiter: backslashes are part of the regex syntax
+    return text.replace('/', r'\/')
+
+
+def _sed_escape_replacement(text):
+    return text.replace('\\', '\\\\').replace('/', r'\/').replace('&', r'\&').replace('\n', r'\n')
+
+
+class RemoteBatch(object):
+    def __init__(self):
+        self._files = []
+        self._targets = []
+        self._commands = []
+
+    def _target(self, path):
+        if path not in self._targets:
+            self._targets.append(path)
+
+    def _add_file(self, name, content=None, source=None):
+        self._files.append((name, content, source))
+        return name
+
+    def upload(self, source_file, dest_dir, mode=None):
+        """
+        Upload a local file (following symbolic links) into `dest_dir`
+        """
+
+        dest = os.path.join(dest_dir, os.path.basename(source_file))
+        name = self._add_file('files/{0}'.format(len(self._files)), source=os.path.realpath(source_file))
+        self._target(dest)
+        self._commands.append('mkdir -p {0}'.format(quote(dest_dir)))
+        self._commands.append('cp -f {0} {1}'.format(name, quote(dest)))
+        if mode:
+            self._commands.append('chmod {0} {1}'.format(mode, quote(dest)))
+
+    def sed(self, path, before, after):
+        """
+        Replace `before` (an extended regex) with `after` in a remote file, like `fabric.contrib.files.sed`
+        """
+
+        name = self._add_file('edits/{0}.sed'.format(len(self._files)),
+                              content='s/{0}/{1}/g\n'.format(_sed_escape_regex(before), _sed_escape_replacement(after)))
+        self._target(path)
+        self._commands.append('sed -i -r -f {0} {1}'.format(name, quote(path)))
+
+    def script(self):
+        lines = [SCRIPT_HEADER.rstrip('\n')]
+        lines += ['    restore {0} {1}'.format(quote(path), i) for i, path in enumerate(self._targets)]
+        lines += ['    exit 1', '}', '']
+        lines += ['backup {0} {1}'.format(quote(path), i) for i, path in enumerate(self._targets)]
+        lines += ['', 'trap rollback ERR', '']
+        lines += self._commands
+        return '\n'.join(lines) + '\n'
+
+    def commit(self, use_sudo=False):
+        """
+        Apply everything on the current host, in one upload and one remote command
+        """
+
+        if not self._commands:
+            return
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tar_path = os.path.join(tmp_dir, 'batch.tar.gz')
+            with tarfile.open(tar_path, 'w:gz') as tar:
+                for name, content, source in self._files + [('apply.sh', self.script(), None)]:
+                    if source is None:
+                        source = os.path.join(tmp_dir, os.path.basename(name))
+                        with open(source, 'w') as f:
+                            f.write(content)
+                    tar.add(source, arcname=name)
+
+            remote_dir = '/tmp/remote-batch-{0}'.format(uuid.uuid4().hex)
+            put(tar_path, remote_dir + '.tar.gz', use_sudo=use_sudo)
+            (sudo if use_sudo else run)(
+                'mkdir -p {0} && tar -xzf {0}.tar.gz -C {0} && bash {0}/apply.sh; '
+                'rc=$?; rm -rf {0} {0}.tar.gz; exit $rc'.format(remote_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+@contextmanager
+def remote_batch(use_sudo=False):
+    """
+    Collect the edits made in the block, and apply them when it exits (unless it raised)
+    """
+
+    batch = RemoteBatch()
+    yield batch
+    batch.commit(use_sudo=use_sudo)
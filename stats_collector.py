@@ -0,0 +1,273 @@
+"""
+Performance metrics of an Indico server, as JSON.
+
+This script is sent by `fab stats` and run on the server itself, with the
+system Python and no other dependency, so that all the metrics are collected
+in a single SSH command. The settings are passed as a JSON argument:
+
+    {"apache_status_url": "http://localhost/server-status",
+     "redis": [{"name": "redis", "port": 6379, "password": "..."}],
+     "zeo_monitor_port": 9676,
+     "dirs": {"archive": "/opt/indico/archive"},
+     "samples": 1, "interval": 5}
+
+Every source is optional, and failures are reported instead of aborting.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+SCOREBOARD = {
+    '_': 'waiting',
+    'S': 'starting',
+    'R': 'reading',
+    'W': 'sending',
+    'K': 'keepalive',
+    'D': 'dns',
+    'C': 'closing',
+    'L': 'logging',
+    'G': 'finishing',
+    'I': 'idle_cleanup',
+    '.': 'open'
+}
+
+
+def _number(value):
+    for conv in (int, float):
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    return value
+
+
+def apache_status(url):
+    response = urlopen(url + '?auto', timeout=10)
+    try:
+        content = response.read().decode('utf-8', 'replace')
+    finally:
+        response.close()
+
+    status = {}
+    for line in content.splitlines():
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            status[key] = _number(value)
+
+    scoreboard = status.pop('Scoreboard', '')
+    status['scoreboard'] = dict((name, scoreboard.count(char)) for char, name in SCOREBOARD.items())
+    return status
+
+
+def _rss_mb(pid):
+    with open('/proc/{0}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return round(int(line.split()[1]) / 1024.0, 1)
+    return 0
+
+
+def wsgi_processes():
+    """
+    Memory of the mod_wsgi daemon processes (named after their group)
+    """
+
+    processes = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/cmdline'.format(pid)) as f:
+                cmdline = f.read()
+            if cmdline.startswith('(wsgi:'):
+                processes.append({'pid': int(pid), 'group': cmdline.split(')')[0][6:],
+                                  'rss_mb': _rss_mb(pid)})
+        except (IOError, OSError):
+            pass
+
+    return {
+        'count': len(processes),
+        'total_rss_mb': round(sum(p['rss_mb'] for p in processes), 1),
+        'processes': processes
+    }
+
+
+class RedisClient(object):
+    """
+    Just enough of the Redis protocol to run a few commands
+    """
+
+    def __init__(self, port=6379, password=None, unix_socket=None, host='localhost'):
+        if unix_socket:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(unix_socket)
+        else:
+            self._sock = socket.create_connection((host, port), timeout=10)
+        self._file = self._sock.makefile('rb')
+        if password:
+            self.command('AUTH', password)
+
+    def command(self, *args):
+        request = '*{0}\r\n'.format(len(args)) + ''.join(
+            '${0}\r\n{1}\r\n'.format(len(str(arg).encode('utf-8')), arg) for arg in args)
+        self._sock.sendall(request.encode('utf-8'))
+        return self._reply()
+
+    def _reply(self):
+        line = self._file.readline().decode('utf-8', 'replace').rstrip('\r\n')
+        kind, data = line[0], line[1:]
+        if kind == '+':
+            return data
+        elif kind == '-':
+            raise RuntimeError(data)
+        elif kind == ':':
+            return int(data)
+        elif kind == '$':
+            if data == '-1':
+                return None
+            value = self._file.read(int(data) + 2)[:-2]
+            return value.decode('utf-8', 'replace')
+        elif kind == '*':
+            return [self._reply() for _ in range(int(data))] if data != '-1' else None
+        raise RuntimeError("Unexpected reply '{0}'".format(line))
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def redis_stats(port=6379, password=None, unix_socket=None, slowlog=10):
+    client = RedisClient(port, password, unix_socket)
+    try:
+        info = {}
+        keyspace = {}
+        for line in client.command('INFO').splitlines():
+            if ':' not in line or line.startswith('#'):
+                continue
+            key, value = line.split(':', 1)
+            if key.startswith('db') and key[2:].isdigit():
+                keyspace[key] = dict((k, _number(v)) for k, v in (kv.split('=') for kv in value.split(',')))
+            else:
+                info[key] = _number(value)
+        slowlog_len = client.command('SLOWLOG', 'LEN')
+        entries = client.command('SLOWLOG', 'GET', slowlog)
+    finally:
+        client.close()
+
+    hits, misses = info.get('keyspace_hits', 0), info.get('keyspace_misses', 0)
+    keys = ('redis_version', 'uptime_in_seconds', 'connected_clients', 'blocked_clients', 'used_memory',
+            'used_memory_rss', 'mem_fragmentation_ratio', 'maxmemory', 'evicted_keys', 'expired_keys',
+            'instantaneous_ops_per_sec', 'total_commands_processed', 'rdb_changes_since_last_save',
+            'rdb_last_bgsave_status', 'aof_enabled', 'latest_fork_usec', 'keyspace_hits', 'keyspace_misses')
+    return {
+        'info': dict((k, info[k]) for k in keys if k in info),
+        # Redis only counts hits and misses per instance
+        'hit_ratio': round(float(hits) / (hits + misses), 4) if hits + misses else None,
+        'keyspace': keyspace,
+        'slowlog_len': slowlog_len,
+        'slowlog': [{'id': e[0], 'time': e[1], 'duration_us': e[2], 'command': ' '.join(e[3])[:200]}
+                    for e in entries]
+    }
+
+
+def zeo_stats(port):
+    """
+    Statistics of the ZEO monitor server (see 'monitor-address' in zodb.conf)
+    """
+
+    sock = socket.create_connection(('localhost', port), timeout=10)
+    chunks = []
+    try:
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+
+    stats = {}
+    storage = None
+    for line in b''.join(chunks).decode('utf-8', 'replace').splitlines():
+        if ': ' not in line:
+            continue
+        key, value = line.split(': ', 1)
+        key = key.strip().lower().replace(' ', '_')
+        if key == 'storage':
+            storage = stats.setdefault(value, {})
+        elif storage is not None:
+            storage[key] = _number(value)
+    return stats
+
+
+def disk_usage(dirs):
+    usage = {}
+    for name, path in dirs.items():
+        try:
+            with open(os.devnull, 'w') as devnull:
+                output = subprocess.Popen(['du', '-sb', path], stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+            usage[name] = {'path': path, 'bytes': int(output.split()[0])}
+        except (OSError, IndexError, ValueError):
+            usage[name] = {'path': path, 'error': 'unavailable'}
+    return usage
+
+
+def system_stats():
+    with open('/proc/loadavg') as f:
+        load = [float(v) for v in f.read().split()[:3]]
+    memory = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ('MemTotal', 'MemFree', 'MemAvailable', 'Cached', 'SwapTotal', 'SwapFree'):
+                memory[key] = int(value.split()[0]) // 1024
+    return {'loadavg': load, 'memory_mb': memory}
+
+
+def _collect(name, func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        return {'error': '{0}: {1}'.format(name, e)}
+
+
+def sample(settings):
+    result = {
+        'time': time.time(),
+        'system': _collect('system', system_stats)
+    }
+    if settings.get('apache_status_url'):
+        result['apache'] = _collect('apache', apache_status, settings['apache_status_url'])
+        result['wsgi'] = _collect('wsgi', wsgi_processes)
+    if settings.get('redis'):
+        result['redis'] = dict((r['name'], _collect(r['name'], redis_stats, r.get('port'), r.get('password'),
+                                                    r.get('socket')))
+                               for r in settings['redis'])
+    if settings.get('zeo_monitor_port'):
+        result['zeo'] = _collect('zeo', zeo_stats, settings['zeo_monitor_port'])
+    if settings.get('dirs'):
+        result['disk'] = disk_usage(settings['dirs'])
+    return result
+
+
+def main(settings):
+    samples = []
+    for i in range(int(settings.get('samples', 1))):
+        if i:
+            time.sleep(float(settings.get('interval', 5)))
+        samples.append(sample(settings))
+    json.dump(samples if len(samples) > 1 else samples[0], sys.stdout)
+
+
+if __name__ == '__main__':
+    main(json.loads(sys.argv[1]))